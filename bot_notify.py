@@ -20,57 +20,225 @@
 #
 import os
 import sys
+import abc
 import json
+import time
+import base64
+import random
+import logging
+import threading
+import collections
+import urllib.parse
+import concurrent.futures
 import requests
+import requests.adapters
 import click
 import importlib
 import keyring
-import traceback
 
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+except ImportError:
+    Fernet = None
+    InvalidToken = ValueError
+
+
+class NotifyError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class NotifyTransport:
+    """Posts bot messages over one pooled requests.Session per host.
+
+    Keeping the sessions around saves the TCP and TLS handshakes of every
+    message after the first. Every request has a connect and a read timeout.
+    Connection errors, timeouts, 5xx replies and rate limiting are retried
+    with exponential backoff and jitter, or after the Retry-After delay the
+    server asked for.
+    """
+
+    def __init__(self, connect_timeout=3.05, read_timeout=10, retries=3,
+                 backoff=0.5, max_backoff=30, pool_size=10):
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.pool_size = pool_size
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def session(self, url):
+        """Returns the session for the host of url."""
+        parts = urllib.parse.urlsplit(url)
+        host = (parts.scheme, parts.netloc)
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount(parts.scheme + '://', adapter)
+                session.headers['Content-Type'] = 'application/json'
+                self._sessions[host] = session
+        return session
+
+    def reserve(self, connections):
+        """Makes the pools large enough for that many concurrent posts.
+
+        Sessions with smaller pools are dropped, to be made again with the
+        new size. Requests still running on them are not affected.
+        """
+        with self._lock:
+            if connections <= self.pool_size:
+                return
+            self.pool_size = connections
+            self._sessions = {}
+
+    def close(self):
+        with self._lock:
+            sessions, self._sessions = self._sessions, {}
+        for session in sessions.values():
+            session.close()
+
+    def _delay(self, attempt, response=None):
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+            if retry_after is not None and retry_after.isdigit():
+                return min(int(retry_after), self.max_backoff)
+        delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def post(self, url, data, rate_limited=None):
+        """Posts data as JSON to url.
+
+        Args:
+            rate_limited: Called with a response with a 2xx status, returns
+                whether the bot rejected the message for its rate limit,
+                which some bots report in the body only.
+
+        Returns:
+            The response.
+
+        Raises:
+            NotifyError: When the message could not be delivered, after all
+                retries.
+        """
+        session = self.session(url)
+        body = json.dumps(data)
+        for attempt in range(self.retries + 1):
+            response = None
+            try:
+                response = session.post(url, data=body, timeout=self.timeout)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                # The message of e has the url, and the url the bot key.
+                error = type(e).__name__
+            else:
+                if response.status_code == 429:
+                    error = 'rate limited'
+                elif response.status_code >= 500:
+                    error = 'server error {:d}'.format(response.status_code)
+                elif response.ok and rate_limited and rate_limited(response):
+                    error = 'rate limited'
+                elif not response.ok:
+                    raise NotifyError('{:s}: status {:d}'.format(
+                        urllib.parse.urlsplit(url).netloc,
+                        response.status_code), response.status_code)
+                else:
+                    return response
+            if attempt == self.retries:
+                break
+            delay = self._delay(attempt, response)
+            logging.warning('Notify %s: %s, retrying in %.1fs',
+                            urllib.parse.urlsplit(url).netloc, error, delay)
+            time.sleep(delay)
+        raise NotifyError('{:s}: {:s} after {:d} attempts'.format(
+            urllib.parse.urlsplit(url).netloc, error, self.retries + 1),
+            response.status_code if response is not None else None)
+
+
+transport = NotifyTransport()
+
+
+class Bot(abc.ABC):
+    """A chat bot webhook, posting through the shared transport."""
+
+    server = None
 
-class WxBot:
     def __init__(self, name, apikey):
         self.name = name
         self.apikey = apikey
-        pass
 
-    def send_notify(self, msg, run=True):
-        click.echo("send notify to %s run: %s" % (self.name, run))
-        # data to be sent to api
-        data = {
+    @abc.abstractmethod
+    def payload(self, title, msg):
+        """Returns the JSON body posting a message to the bot."""
+
+    def rate_limited(self, response):
+        return False
+
+    def error(self, response):
+        """Returns the error a 2xx reply reports in its body, or None."""
+        return None
+
+    def post(self, title, msg):
+        """Posts a message, returns the response or raises NotifyError."""
+        response = transport.post(self.server + self.apikey,
+                                  self.payload(title, msg), self.rate_limited)
+        error = self.error(response)
+        if error is not None:
+            raise NotifyError('{:s}: {:s}'.format(self.name, error),
+                              response.status_code)
+        return response
+
+
+def _json_code(response, key):
+    try:
+        return response.json().get(key)
+    except (ValueError, AttributeError):
+        return None
+
+
+def _json_error(response, code_key, msg_key):
+    """Returns "error <code>: <msg>" for a non-zero code in the body."""
+    try:
+        body = response.json()
+        code = body.get(code_key)
+    except (ValueError, AttributeError):
+        return None
+    if not code:
+        return None
+    return 'error {}: {}'.format(code, body.get(msg_key, ''))
+
+
+class WxBot(Bot):
+    server = "https://qyapi.weixin.qq.com/cgi-bin/webhook/send?key="
+
+    def payload(self, title, msg):
+        return {
             'msgtype' : 'markdown',
             "markdown": {
-                'content': msg,
+                'content': '# %s\n%s' % (title, msg) if title else msg,
                 'mentioned_list' :["@all"]
             }
         }
-        print(msg)
-        if not run:
-            return
 
-        server = "https://qyapi.weixin.qq.com/cgi-bin/webhook/send?key=" + \
-            self.apikey
-        try:
-            r = requests.post(url = server, data = json.dumps(data),
-                              headers = {'Content-Type': 'application/json'})
-            click.echo("Notify weixin server, status: {}".format(r.status_code))
-            return True
-        except requests.exceptions.ConnectionError as e:
-            click.echo("Notify weixin server failed".format(r.status_code))
-            traceback.print_exception(*sys.exc_info())
-        return False
-    pass
+    def rate_limited(self, response):
+        # errcode 45009: api freq out of limit
+        return _json_code(response, 'errcode') == 45009
 
-class FsBot:
-    def __init__(self, name, apikey):
-        self.name = name
-        self.apikey = apikey
-        pass
+    def error(self, response):
+        return _json_error(response, 'errcode', 'errmsg')
 
-    def send_notify(self, title, msg, run=True):
-        click.echo("send notify to %s run: %s" % (self.name, run))
-        # data to be sent to api
-        data = {
+
+class FsBot(Bot):
+    server = "https://open.feishu.cn/open-apis/bot/v2/hook/"
+
+    def payload(self, title, msg):
+        return {
             "msg_type": "post",
             "content": {
                 "post": {
@@ -89,22 +257,12 @@ class FsBot:
             }
         }
 
-        print(msg)
-        if not run:
-            return
-
-        server = "https://open.feishu.cn/open-apis/bot/v2/hook/" + \
-            self.apikey
-        try:
-            r = requests.post(url = server, data = json.dumps(data),
-                          headers = {'Content-Type': 'application/json'})
-            click.echo("Notify feishu server, status: {}".format(r.status_code))
-            return True
-        except requests.exceptions.ConnectionError as e:
-            click.echo("Notify feishu server failed".format(r.status_code))
-            traceback.print_exception(*sys.exc_info())
+    def rate_limited(self, response):
+        # code 11232: frequency limited
+        return _json_code(response, 'code') == 11232
 
-        return False
+    def error(self, response):
+        return _json_error(response, 'code', 'msg')
 
 NotifyBots = [FsBot, WxBot]
 
@@ -120,27 +278,268 @@ def str_to_class(module_name, class_name):
         logging.error('Module does not exist')
     return class_ or None
 
+class SecretCache:
+    """Caches bot secrets in memory for ttl seconds.
+
+    Looking a secret up in the keyring may be a D-Bus round trip to the
+    Secret Service, or hang when no keyring daemon runs. Lookups are
+    therefore cached, and given up after keyring_timeout seconds.
+
+    Where no keyring daemon runs at all, e.g. from cron or systemd, the
+    secrets can come from an encrypted file instead. It is used when the
+    BOT_NOTIFY_CACHE_KEY environment variable, or the bot-notify-cache-key
+    systemd credential, holds a passphrase, and the cryptography module is
+    installed. The file is then read before the keyring is asked, so that
+    unattended runs never wait for a keyring. Secrets found in the keyring,
+    or given to set(), are saved there, so one interactive run fills it for
+    later unattended ones. A secret changed in the keyring is only picked up
+    after invalidate().
+    """
+
+    KEY_ENV = 'BOT_NOTIFY_CACHE_KEY'
+    KEY_CREDENTIAL = 'bot-notify-cache-key'
+    ITERATIONS = 200000
+
+    def __init__(self, ttl=300, path=None, keyring_timeout=5):
+        self.ttl = ttl
+        self.keyring_timeout = keyring_timeout
+        if path is None:
+            cache = os.environ.get('XDG_CACHE_HOME',
+                                   os.path.expanduser('~/.cache'))
+            path = os.path.join(cache, 'bot_notify', 'secrets')
+        self.path = path
+        self._secrets = {}
+        self._fernets = {}
+        self._lock = threading.Lock()
+
+    def _passphrase(self):
+        passphrase = os.environ.get(self.KEY_ENV)
+        if passphrase:
+            return passphrase.encode()
+        credentials = os.environ.get('CREDENTIALS_DIRECTORY')
+        if credentials:
+            try:
+                with open(os.path.join(credentials, self.KEY_CREDENTIAL),
+                          'rb') as f:
+                    return f.read().strip() or None
+            except OSError:
+                pass
+        return None
+
+    def _fernet(self, salt):
+        """Returns the file cipher for salt, or None without a passphrase.
+
+        The key derivation is slow on purpose, so its result is kept for
+        the life of the process, and the salt of the file is kept across
+        writes.
+        """
+        passphrase = self._passphrase()
+        if passphrase is None:
+            return None
+        if Fernet is None:
+            logging.warning('%s is set, but the secret cache file needs the '
+                            'cryptography module', self.KEY_ENV)
+            return None
+        fernet = self._fernets.get((passphrase, salt))
+        if fernet is None:
+            kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt,
+                             iterations=self.ITERATIONS)
+            fernet = Fernet(base64.urlsafe_b64encode(kdf.derive(passphrase)))
+            self._fernets[(passphrase, salt)] = fernet
+        return fernet
+
+    def _load_file(self):
+        """Returns the salt and the secrets of the encrypted file.
+
+        Both are None when the file is missing or can not be decrypted.
+        """
+        if self._passphrase() is None:
+            return None, None
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            salt = base64.b64decode(data['salt'])
+            fernet = self._fernet(salt)
+            if fernet is None:
+                return None, None
+            return salt, json.loads(fernet.decrypt(data['token'].encode()))
+        except FileNotFoundError:
+            return None, None
+        except (OSError, ValueError, KeyError, InvalidToken) as e:
+            logging.warning('Ignoring secret cache %s: %s', self.path,
+                            type(e).__name__)
+            return None, None
+
+    def _save_file(self, update):
+        """Applies update to the secrets of the encrypted file."""
+        salt, secrets = self._load_file()
+        if salt is None:
+            salt, secrets = os.urandom(16), {}
+        fernet = self._fernet(salt)
+        if fernet is None:
+            return
+        update(secrets)
+        token = fernet.encrypt(json.dumps(secrets).encode()).decode()
+        try:
+            os.makedirs(os.path.dirname(self.path), mode=0o700,
+                        exist_ok=True)
+            tmp = self.path + '.tmp'
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'salt': base64.b64encode(salt).decode(),
+                           'token': token}, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logging.warning('Failed to write secret cache %s: %s', self.path,
+                            e)
+
+    def _keyring_get(self, pwkey):
+        result = []
+
+        def lookup():
+            try:
+                result.append(keyring.get_password('BotNotify', pwkey))
+            except keyring.errors.KeyringError as e:
+                logging.warning('Keyring lookup of %s failed: %s', pwkey, e)
+
+        thread = threading.Thread(target=lookup, daemon=True)
+        thread.start()
+        thread.join(self.keyring_timeout)
+        if thread.is_alive():
+            logging.warning('Keyring lookup of %s timed out', pwkey)
+            return None
+        return result[0] if result else None
+
+    def get(self, pwkey):
+        """Returns the secret of pwkey, or None when it is not known."""
+        now = time.monotonic()
+        with self._lock:
+            cached = self._secrets.get(pwkey)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+
+        salt, secrets = self._load_file()
+        secret = (secrets or {}).get(pwkey)
+        if secret is None:
+            secret = self._keyring_get(pwkey)
+            if secret is not None and self._passphrase() is not None:
+                self._save_file(lambda secrets: secrets.update({
+                    pwkey: secret}))
+        if secret is not None:
+            with self._lock:
+                self._secrets[pwkey] = (secret, now + self.ttl)
+        return secret
+
+    def set(self, pwkey, secret):
+        """Saves a secret to the keyring, and to the caches.
+
+        Without a working keyring, the secret still goes to the file.
+        """
+        try:
+            keyring.set_password('BotNotify', pwkey, secret)
+        except keyring.errors.KeyringError as e:
+            logging.warning('Failed to save %s to the keyring: %s', pwkey, e)
+        with self._lock:
+            self._secrets[pwkey] = (secret, time.monotonic() + self.ttl)
+        self._save_file(lambda secrets: secrets.update({pwkey: secret}))
+
+    def invalidate(self, pwkey=None):
+        """Forgets the cached secret of pwkey, or all cached secrets.
+
+        The keyring is left alone, the next get() reads it again.
+        """
+        with self._lock:
+            if pwkey is None:
+                self._secrets.clear()
+            else:
+                self._secrets.pop(pwkey, None)
+        if pwkey is None:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+        elif os.path.exists(self.path):
+            self._save_file(lambda secrets: secrets.pop(pwkey, None))
+
+
+secret_cache = SecretCache()
+
+
+def invalidate_secret(bottype=None, botname=None):
+    """Forgets the cached secret of a bot, or of all bots."""
+    if bottype is None:
+        secret_cache.invalidate()
+    else:
+        secret_cache.invalidate(bottype + '_' + botname)
+
+
+NotifyResult = collections.namedtuple(
+    'NotifyResult', ['bottype', 'botname', 'success', 'status', 'latency',
+                     'error'])
+
+
+def _send(bot, btype, title, message):
+    start = time.monotonic()
+    try:
+        r = bot.post(title, message)
+        return NotifyResult(btype, bot.name, True, r.status_code,
+                            time.monotonic() - start, None)
+    except NotifyError as e:
+        return NotifyResult(btype, bot.name, False, e.status,
+                            time.monotonic() - start, str(e))
+
+
 def notify_robot(bottype, botname, secret = None, title = 'Title', message = 'Message', run = True):
-    """send notify to chat robot"""
+    """send notify to chat robot
+
+    The secrets are looked up one bot after the other, since that may ask
+    for them on the terminal, then the message is posted to all the bots at
+    once, so that it takes about one round trip however many bots there are.
+
+    Returns:
+        A NotifyResult per bot, in the order of the bots. With run=False,
+        nothing is posted and success is None.
+    """
 
     if len(bottype) != len(botname):
         click.secho("bottype option's number must equal to botname's number");
         exit(-1)
 
+    bots = []
     for (btype, bname) in list(map(lambda x, y: [x, y], bottype, botname)):
         click.secho("Send to %s with %s\n" % (bname, btype))
         _class = str_to_class(__name__, btype)
         pwkey = btype + '_' + bname
-        if secret is None:
-            secret = keyring.get_password('BotNotify', pwkey)
-        if secret is None:
+        bot_secret = secret
+        if bot_secret is None:
+            bot_secret = secret_cache.get(pwkey)
+        if bot_secret is None:
             import getpass
-            secret = getpass.getpass('Please input the secret key for bot %s\n' % (pwkey))
-            keyring.set_password('BotNotify', pwkey, secret)
+            bot_secret = getpass.getpass('Please input the secret key for bot %s\n' % (pwkey))
+            secret_cache.set(pwkey, bot_secret)
             click.secho('Secret for bot %s saved to keyring' % (pwkey), bg='black', fg='green')
 
-        bot = _class(bname, secret)
-        return bot.send_notify(title, message, run)
+        bots.append((btype, _class(bname, bot_secret)))
+
+    print(message)
+    if not run:
+        return [NotifyResult(btype, bot.name, None, None, 0.0, None)
+                for btype, bot in bots]
+
+    transport.reserve(len(bots))
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, len(bots))) as executor:
+        results = list(executor.map(lambda item: _send(item[1], item[0],
+                                                       title, message),
+                                    bots))
+    for result in results:
+        if result.success:
+            click.echo("Notify %s with %s, status: %d in %.3fs" % (
+                result.botname, result.bottype, result.status, result.latency))
+        else:
+            click.echo("Notify %s with %s failed in %.3fs: %s" % (
+                result.botname, result.bottype, result.latency, result.error))
+    return results
 
 @click.command()
 @click.option('--bottype', multiple=True,
@@ -151,9 +550,14 @@ def notify_robot(bottype, botname, secret = None, title = 'Title', message = 'Me
 @click.option('-t', '--title', default="消息同步")
 @click.option('-m', '--message', default="Test notify message")
 @click.option('--run/--try-run', default=True)
-def notify_robot_cli(bottype, botname, secret, title, message, run):
-    ret = notify_robot(bottype, botname, secret, title, message, run)
-    if ret:
+@click.option('--forget', is_flag=True,
+              help = 'forget the cached secrets of the bots before sending')
+def notify_robot_cli(bottype, botname, secret, title, message, run, forget):
+    if forget:
+        for (btype, bname) in zip(bottype, botname):
+            invalidate_secret(btype, bname)
+    results = notify_robot(bottype, botname, secret, title, message, run)
+    if any(result.success is False for result in results):
         sys.exit(-1)
 
     return
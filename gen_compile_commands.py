@@ -11,13 +11,16 @@ import argparse
 import json
 import logging
 import os
-import re
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from kbuild_cmd import CmdIndex, PathCache, scan_tree
 
 _DEFAULT_OUTPUT = 'compile_commands.json'
 _DEFAULT_LOG_LEVEL = 'WARNING'
+_INDEX_SUFFIX = '.cmdindex'
 
-_FILENAME_PATTERN = r'^\..*\.cmd$'
-_LINE_PATTERN = r'^cmd_[^ ]*\.o := (.* )([^ ]*\.c)$'
 _VALID_LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
 
 # A kernel build generally has over 2000 entries in its compile_commands.json
@@ -33,6 +36,10 @@ def parse_arguments():
         log_level: A logging level to filter log output.
         directory: The directory to search for .cmd files.
         output: Where to write the compile-commands JSON file.
+        outtype: Only write this key of each entry, or None for full entries.
+        jobs: The number of worker processes used to scan the tree.
+        incremental: Whether to reuse the .cmd index next to the output.
+        compact: Whether to write the database without indentation.
     """
     usage = 'Creates a compile_commands.json database from kernel .cmd files'
     parser = argparse.ArgumentParser(description=usage)
@@ -49,6 +56,19 @@ def parse_arguments():
                         'file-only)')
     parser.add_argument('-t', '--outtype', type=str, help=output_type_help)
 
+    jobs_help = ('The number of worker processes used to parse .cmd files '
+                 '(defaults to 1)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help=jobs_help)
+
+    incremental_help = ('Only re-read .cmd files that changed since the last '
+                        'run, using an index stored next to the output file')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help=incremental_help)
+
+    compact_help = ('Write the database on a single line instead of indenting '
+                    'every entry')
+    parser.add_argument('--compact', action='store_true', help=compact_help)
+
     log_level_help = ('The level of log messages to produce (one of ' +
                       ', '.join(_VALID_LOG_LEVELS) + '; defaults to ' +
                       _DEFAULT_LOG_LEVEL + ')')
@@ -67,91 +87,105 @@ def parse_arguments():
     directory = os.path.abspath(directory)
     outtype = args.outtype or None
 
-    return log_level, directory, output, outtype
+    jobs = args.jobs
+    if jobs < 1:
+        raise ValueError('%d is not a valid number of jobs' % jobs)
+
+    return (log_level, directory, output, outtype, jobs, args.incremental,
+            args.compact)
 
 
-def process_line(root_directory, file_directory, command_prefix, relative_path):
-    """Extracts information from a .cmd line and creates an entry from it.
+def scan_tree_incremental(directory, index_path, jobs=1,
+                          log_level=logging.WARNING, path_cache=None):
+    """Like scan_tree(), but only re-reads .cmd files that changed.
 
     Args:
-        root_directory: The directory that was searched for .cmd files. Usually
-            used directly in the "directory" entry in compile_commands.json.
-        file_directory: The path to the directory the .cmd file was found in.
-        command_prefix: The extracted command line, up to the last element.
-        relative_path: The .c file from the end of the extracted command.
-            Usually relative to root_directory, but sometimes relative to
-            file_directory and sometimes neither.
+        directory: The directory to search for .cmd files.
+        index_path: Where the CmdIndex of the previous run is kept.
+        jobs: The number of worker processes used for changed files.
+        log_level: The logging level to set up in worker processes.
+        path_cache: A PathCache for the existence checks, as for scan_tree().
+
+    Yields:
+        The entries, identical to what scan_tree() would produce. The index is
+        updated as they are produced, see CmdIndex.refresh().
+    """
+    with CmdIndex(index_path, directory) as index:
+        for entry in index.refresh(directory, jobs, log_level, path_cache):
+            yield entry
 
-    Returns:
-        An entry to append to compile_commands.
 
-    Raises:
-        ValueError: Could not find the extracted file based on relative_path and
-            root_directory or file_directory.
+def write_compile_commands(f, entries, indent=2):
+    """Writes entries to f as a JSON array while they are being produced.
+
+    The output is byte-identical to json.dump(list(entries), f, indent=indent,
+    sort_keys=True), but only one entry is held in memory at a time.
+
+    Args:
+        f: The text file to write to.
+        entries: An iterable of entries, consumed exactly once.
+        indent: The indentation used by json.dump(), or None for the compact
+            single-line form.
+
+    Returns:
+        The number of entries written.
     """
-    # The .cmd files are intended to be included directly by Make, so they
-    # escape the pound sign '#', either as '\#' or '$(pound)' (depending on the
-    # kernel version). The compile_commands.json file is not interepreted
-    # by Make, so this code replaces the escaped version with '#'.
-    prefix = command_prefix.replace('\#', '#').replace('$(pound)', '#')
-
-    cur_dir = root_directory
-    expected_path = os.path.join(cur_dir, relative_path)
-    if not os.path.exists(expected_path):
-        # Try using file_directory instead. Some of the tools have a different
-        # style of .cmd file than the kernel.
-        cur_dir = file_directory
-        expected_path = os.path.join(cur_dir, relative_path)
-        if not os.path.exists(expected_path):
-            raise ValueError('File %s not in %s or %s' %
-                             (relative_path, root_directory, file_directory))
-    return {
-        'directory': cur_dir,
-        'file': relative_path,
-        'command': prefix + relative_path,
-    }
+    if indent is None:
+        separator = ', '
+        newline = ''
+    else:
+        separator = ','
+        newline = '\n' + ' ' * indent
+
+    count = 0
+    f.write('[')
+    for entry in entries:
+        if count:
+            f.write(separator)
+        encoded = json.dumps(entry, indent=indent, sort_keys=True)
+        f.write(newline)
+        f.write(encoded.replace('\n', newline) if newline else encoded)
+        count += 1
+    if count and indent is not None:
+        f.write('\n')
+    f.write(']')
+    return count
 
 
 def main():
     """Walks through the directory and finds and parses .cmd files."""
-    log_level, directory, output, outtype = parse_arguments()
+    (log_level, directory, output, outtype, jobs, incremental,
+     compact) = parse_arguments()
 
     level = getattr(logging, log_level)
     logging.basicConfig(format='%(levelname)s: %(message)s', level=level)
 
-    filename_matcher = re.compile(_FILENAME_PATTERN)
-    line_matcher = re.compile(_LINE_PATTERN)
-
-    compile_commands = []
-    for dirpath, _, filenames in os.walk(directory):
-        for filename in filenames:
-            if not filename_matcher.match(filename):
-                continue
-            filepath = os.path.join(dirpath, filename)
-
-            with open(filepath, 'rt') as f:
-                for line in f:
-                    result = line_matcher.match(line)
-                    if not result:
-                        continue
-
-                    try:
-                        entry = process_line(directory, dirpath,
-                                             result.group(1), result.group(2))
-                        if outtype is not None:
-                            compile_commands.append(entry[outtype])
-                            pass
-                        else:
-                            compile_commands.append(entry)
-                            pass
-                    except ValueError as err:
-                        logging.info('Could not add line from %s: %s',
-                                     filepath, err)
-
-    with open(output, 'wt') as f:
-        json.dump(compile_commands, f, indent=2, sort_keys=True)
-
-    count = len(compile_commands)
+    path_cache = PathCache()
+    if incremental:
+        compile_commands = scan_tree_incremental(
+            directory, output + _INDEX_SUFFIX, jobs, level, path_cache)
+    else:
+        compile_commands = scan_tree(directory, jobs, level, path_cache)
+    if outtype is not None:
+        compile_commands = (entry[outtype] for entry in compile_commands)
+
+    # Write next to the output and rename it into place, so that clangd never
+    # sees a half-written database while the tree is still being scanned.
+    tmp_output = output + '.tmp'
+    try:
+        with open(tmp_output, 'wt') as f:
+            count = write_compile_commands(f, compile_commands,
+                                           None if compact else 2)
+        os.replace(tmp_output, output)
+    except BaseException:
+        if os.path.exists(tmp_output):
+            os.remove(tmp_output)
+        raise
+
+    logging.info('Answered %d path checks from %d directory listings '
+                 '(%d stat calls avoided)', path_cache.lookups,
+                 path_cache.listings, path_cache.avoided)
+
     if count < _LOW_COUNT_THRESHOLD:
         logging.warning(
             'Found %s entries. Have you compiled the kernel?', count)
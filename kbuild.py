@@ -8,15 +8,28 @@
 """A tool for recompile single file in the Linux kernel."""
 
 import argparse
-import json
+import concurrent.futures
 import logging
 import os
-import re
+import shlex
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from kbuild_cmd import CmdIndex, PathCache, entry_source, parse_cmd_deps
 
 _DEFAULT_LOG_LEVEL = 'WARNING'
+_DEFAULT_INDEX = '.kbuild.cmdindex'
+
+# Characters that only mean something to a shell. Commands containing them
+# outside of quotes are still run through /bin/sh.
+_SHELL_OPERATORS = '();<>|&'
+_SHELL_EXPANSIONS = '$`'
 
-_FILENAME_PATTERN = r'^\..*\.cmd$'
-_LINE_PATTERN = r'^cmd_[^ ]*\.o := (.* )([^ ]*\.c)$'
 _VALID_LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
 
 def parse_arguments():
@@ -25,6 +38,10 @@ def parse_arguments():
     Returns:
         log_level: A logging level to filter log output.
         directory: The directory to search for .cmd files.
+        kernel_directory: The kernel source directory.
+        index: Where to keep the index of .cmd files.
+        jobs: The number of compile commands to run at once.
+        force: Whether to rebuild objects that are up to date.
     """
     usage = 'Recompile Single file from kernel .cmd files'
     parser = argparse.ArgumentParser(description=usage)
@@ -37,6 +54,19 @@ def parse_arguments():
                       '(defaults to kernel source directory)')
     parser.add_argument('-d', '--directory', type=str, help=directory_help)
 
+    index_help = ('Where to keep the index of parsed .cmd files (defaults to '
+                  + _DEFAULT_INDEX + ' in the kernel source directory)')
+    parser.add_argument('-i', '--index', type=str, help=index_help)
+
+    jobs_help = ('The number of compile commands to run at once '
+                 '(defaults to 1)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help=jobs_help)
+
+    force_help = ('Rebuild every object of the directory, even if it is newer '
+                  'than all of its sources and headers')
+    parser.add_argument('-B', '--always-make', dest='force',
+                        action='store_true', help=force_help)
+
     log_level_help = ('The level of log messages to produce (one of ' +
                       ', '.join(_VALID_LOG_LEVELS) + '; defaults to ' +
                       _DEFAULT_LOG_LEVEL + ')')
@@ -52,57 +82,173 @@ def parse_arguments():
 
     kernel_directory = args.kernel or os.getcwd()
     kernel_directory = os.path.abspath(kernel_directory)
-    directory = os.path.join(kernel_directory, args.directory) or kernel_directory
+    directory = os.path.join(kernel_directory, args.directory or '')
     directory = os.path.abspath(directory)
+    index = args.index or os.path.join(kernel_directory, _DEFAULT_INDEX)
+
+    jobs = args.jobs
+    if jobs < 1:
+        raise ValueError('%d is not a valid number of jobs' % jobs)
+
+    return log_level, directory, kernel_directory, index, jobs, args.force
 
-    return log_level, directory, kernel_directory
 
+def open_index(index, kernel_directory):
+    """Opens the .cmd index, or an in-memory one if it can not be written."""
+    try:
+        return CmdIndex(index, kernel_directory)
+    except sqlite3.Error as err:
+        logging.warning('Could not open index %s (%s), not keeping one',
+                        index, err)
+        return CmdIndex(':memory:', kernel_directory)
 
-def process_line(root_directory, file_directory, command_prefix, relative_path):
-    """Extracts information from a .cmd line and creates an entry from it.
 
-    Args:
-        root_directory: The directory that was searched for .cmd files. Usually
-            used directly in the "directory" entry in compile_commands.json.
-        file_directory: The path to the directory the .cmd file was found in.
-        command_prefix: The extracted command line, up to the last element.
-        relative_path: The .c file from the end of the extracted command.
-            Usually relative to root_directory, but sometimes relative to
-            file_directory and sometimes neither.
+def split_command(command):
+    """Splits a compile command into an argument list.
 
     Returns:
-        An entry to append to compile_commands.
+        The arguments to pass to subprocess, or None if the command uses shell
+        syntax and has to be run through a shell.
+    """
+    if any(c in command for c in _SHELL_EXPANSIONS):
+        return None
+    lexer = shlex.shlex(command, posix=True, punctuation_chars=_SHELL_OPERATORS)
+    lexer.whitespace_split = True
+    # The kernel passes things like -D"KBUILD_STR(s)=#s", '#' is no comment.
+    lexer.commenters = ''
+    try:
+        argv = list(lexer)
+    except ValueError:
+        return None
+    for arg in argv:
+        if arg and all(c in _SHELL_OPERATORS for c in arg):
+            return None
+    return argv
+
+
+def object_target(compile_command):
+    """Returns the absolute path of the object a compile command writes."""
+    argv = split_command(compile_command['command']) or []
+    for arg, value in zip(argv, argv[1:]):
+        if arg == '-o':
+            return os.path.join(compile_command['directory'], value)
+    return None
+
+
+class UpToDateChecker(object):
+    """Decides like make whether an object needs to be rebuilt.
+
+    kbuild writes the prerequisites of every object into the same .cmd file
+    the compile command comes from. An object is up to date if it exists and
+    none of its source, headers or existing $(wildcard ...) config files is
+    newer. The mtime of every path is looked up only once, since most headers
+    are shared by all objects of a directory.
+    """
+
+    def __init__(self):
+        self.mtimes = {}
 
-    Raises:
-        ValueError: Could not find the extracted file based on relative_path and
-            root_directory or file_directory.
+    def mtime(self, path):
+        if path not in self.mtimes:
+            try:
+                self.mtimes[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                self.mtimes[path] = None
+        return self.mtimes[path]
+
+    def is_up_to_date(self, compile_command):
+        target = object_target(compile_command)
+        if target is None:
+            return False
+        target_mtime = self.mtime(target)
+        if target_mtime is None:
+            return False
+
+        directory = compile_command['directory']
+        cmd_file = os.path.join(os.path.dirname(target),
+                                '.' + os.path.basename(target) + '.cmd')
+        try:
+            sections = parse_cmd_deps(cmd_file)
+        except OSError:
+            return False
+        for name, (required, optional) in sections.items():
+            if os.path.join(directory, name) == target:
+                break
+        else:
+            return False
+
+        for dep in required:
+            dep_mtime = self.mtime(os.path.join(directory, dep))
+            if dep_mtime is None or dep_mtime > target_mtime:
+                return False
+        for dep in optional:
+            dep_mtime = self.mtime(os.path.join(directory, dep))
+            if dep_mtime is not None and dep_mtime > target_mtime:
+                return False
+        return True
+
+
+class JobRunner(object):
+    """Runs compile commands in a bounded pool and streams their output.
+
+    Every line a job prints is written to stdout as soon as it arrives,
+    prefixed with the file being compiled, so the output of concurrent jobs
+    stays readable.
     """
-    # The .cmd files are intended to be included directly by Make, so they
-    # escape the pound sign '#', either as '\#' or '$(pound)' (depending on the
-    # kernel version). The compile_commands.json file is not interepreted
-    # by Make, so this code replaces the escaped version with '#'.
-    prefix = command_prefix.replace('\#', '#').replace('$(pound)', '#')
-
-    cur_dir = root_directory
-    expected_path = os.path.join(cur_dir, relative_path)
-    if not os.path.exists(expected_path):
-        # Try using file_directory instead. Some of the tools have a different
-        # style of .cmd file than the kernel.
-        cur_dir = file_directory
-        expected_path = os.path.join(cur_dir, relative_path)
-        if not os.path.exists(expected_path):
-            raise ValueError('File %s not in %s or %s' %
-                             (relative_path, root_directory, file_directory))
-    return {
-        'directory': cur_dir,
-        'file': relative_path,
-        'command': prefix + relative_path,
-    }
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        with self.lock:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+
+    def run_one(self, compile_command):
+        """Runs one compile command and returns its exit status."""
+        directory = compile_command['directory']
+        command = compile_command['command']
+        prefix = '[{:s}] '.format(compile_command['file'])
+
+        self.write('cd {:s} && {:s}\n'.format(directory, command))
+        argv = split_command(command)
+        if argv is None:
+            argv = ['/bin/sh', '-c', command]
+        try:
+            proc = subprocess.Popen(argv, cwd=directory,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+        except OSError as err:
+            self.write('{:s}{:s}\n'.format(prefix, str(err)))
+            return 127
+        with proc.stdout:
+            for line in proc.stdout:
+                self.write(prefix + line.decode('utf-8', 'replace'))
+        return proc.wait()
+
+    def run(self, compile_commands):
+        """Runs all compile commands.
+
+        Returns:
+            The list of commands that failed.
+        """
+        failed = []
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.jobs) as executor:
+            results = executor.map(self.run_one, compile_commands)
+            for compile_command, status in zip(compile_commands, results):
+                if status != 0:
+                    logging.error('%s failed with status %d',
+                                  compile_command['file'], status)
+                    failed.append(compile_command)
+        return failed
 
 
 def main():
-    """Walks through the directory and finds and parses .cmd files."""
-    log_level, directory, kernel_directory = parse_arguments()
+    """Finds the compile commands of the directory and runs them."""
+    (log_level, directory, kernel_directory, index, jobs,
+     force) = parse_arguments()
 
     level = getattr(logging, log_level)
     logging.basicConfig(format='%(levelname)s: %(message)s', level=level)
@@ -110,46 +256,45 @@ def main():
     logging.debug('log_level %s, direcoty:  %s, kernel_directory: %s',
                                      log_level, directory, kernel_directory)
 
-    filename_matcher = re.compile(_FILENAME_PATTERN)
-    line_matcher = re.compile(_LINE_PATTERN)
-
-    single_file_filter = None;
+    single_file_filter = None
     if os.path.isfile(directory):
-        single_file_filter = directory
+        single_file_filter = os.path.normpath(directory)
         directory = os.path.dirname(directory)
         pass
 
-    compile_commands = []
-    for dirpath, _, filenames in os.walk(directory):
-        for filename in filenames:
-            if not filename_matcher.match(filename):
-                continue
-            filepath = os.path.join(dirpath, filename)
-
-            with open(filepath, 'rt') as f:
-                for line in f:
-                    result = line_matcher.match(line)
-                    if not result:
-                        continue
-
-                    try:
-                        entry = process_line(kernel_directory, dirpath,
-                                             result.group(1), result.group(2))
-                        compile_commands.append(entry)
-                    except ValueError as err:
-                        logging.info('Could not add line from %s: %s',
-                                     filepath, err)
-    for compile_command in compile_commands:
-        if single_file_filter is not None:
-            if single_file_filter != os.path.join(compile_command['directory'],
-                                                  compile_command['file']):
-                continue
-        exec_command = "cd {:s} && {:s}".format(compile_command['directory'],
-                                                compile_command['command'])
-        print(exec_command)
-        os.system(exec_command)
+    path_cache = PathCache()
+    with open_index(index, kernel_directory) as cmd_index:
         if single_file_filter is not None:
-            break
+            compile_commands = cmd_index.find(single_file_filter, path_cache)
+            if not compile_commands:
+                # Not indexed yet, pick up the .cmd files next to it.
+                compile_commands = [
+                    entry for entry in cmd_index.refresh(
+                        directory, path_cache=path_cache)
+                    if entry_source(entry) == single_file_filter]
+        else:
+            compile_commands = list(cmd_index.refresh(
+                directory, path_cache=path_cache))
+    logging.info('Answered %d path checks from %d directory listings '
+                 '(%d stat calls avoided)', path_cache.lookups,
+                 path_cache.listings, path_cache.avoided)
+
+    if single_file_filter is not None:
+        compile_commands = compile_commands[:1]
+    elif not force:
+        checker = UpToDateChecker()
+        outdated = [compile_command for compile_command in compile_commands
+                    if not checker.is_up_to_date(compile_command)]
+        print('Skipped {:d} up-to-date objects, rebuilding {:d}'.format(
+            len(compile_commands) - len(outdated), len(outdated)))
+        compile_commands = outdated
+
+    start = time.time()
+    failed = JobRunner(jobs).run(compile_commands)
+    print('Compiled {:d} files in {:.2f}s with {:d} jobs, {:d} failed'.format(
+        len(compile_commands), time.time() - start, jobs, len(failed)))
+    if failed:
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,554 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: GPL-2.0
+#
+# Schspa (C) 2026
+#
+# Author: Schspa Shi <schspa@gmail.com>
+#
+"""Shared parsing of kernel .cmd files for kbuild.py and gen_compile_commands.py.
+
+process_line() and the .cmd patterns come from the kernel's
+scripts/clang-tools/gen_compile_commands.py.
+"""
+
+import concurrent.futures
+import itertools
+import json
+import logging
+import os
+import re
+import sqlite3
+
+_FILENAME_PATTERN = r'^\..*\.cmd$'
+_LINE_PATTERN = r'^cmd_[^ ]*\.o := (.* )([^ ]*\.c)$'
+_DEPS_PATTERN = r'^(source|deps)_(\S+) := ?(.*)$'
+_WILDCARD_PATTERN = r'\$\(wildcard ([^)]*)\)|(\S+)'
+
+_INDEX_VERSION = 2
+# .cmd files handed to the worker processes, or written to the index, at a
+# time.
+_PARSE_BATCH = 4096
+
+
+class PathCache(object):
+    """Answers file existence checks from one listing per directory.
+
+    process_line() needs to know whether a source file exists below the root
+    or the .cmd file's directory. Asking the filesystem costs one or two stat
+    calls per compile line, which adds up on NFS-mounted trees, while the
+    sources of a kernel directory are spread over only a handful of
+    directories. This cache lists each directory once and answers the checks
+    from memory.
+
+    Attributes:
+        lookups: The number of existence checks answered.
+        listings: The number of directories actually listed.
+    """
+
+    def __init__(self):
+        self.dirs = {}
+        self.lookups = 0
+        self.listings = 0
+
+    def exists(self, path):
+        """Returns whether path names an entry of its parent directory."""
+        self.lookups += 1
+        dirname, basename = os.path.split(path)
+        names = self.dirs.get(dirname)
+        if names is None:
+            self.listings += 1
+            try:
+                names = frozenset(os.listdir(dirname or os.curdir))
+            except OSError:
+                names = frozenset()
+            self.dirs[dirname] = names
+        return basename in names
+
+    def add_stats(self, lookups, listings):
+        """Accounts for the checks done by a cache in another process."""
+        self.lookups += lookups
+        self.listings += listings
+
+    @property
+    def avoided(self):
+        """The number of filesystem calls saved compared to os.path.exists."""
+        return self.lookups - self.listings
+
+
+def process_line(root_directory, file_directory, command_prefix, relative_path,
+                 path_cache=None):
+    """Extracts information from a .cmd line and creates an entry from it.
+
+    Args:
+        root_directory: The directory that was searched for .cmd files. Usually
+            used directly in the "directory" entry in compile_commands.json.
+        file_directory: The path to the directory the .cmd file was found in.
+        command_prefix: The extracted command line, up to the last element.
+        relative_path: The .c file from the end of the extracted command.
+            Usually relative to root_directory, but sometimes relative to
+            file_directory and sometimes neither.
+        path_cache: A PathCache to answer the existence checks from, or None
+            to ask the filesystem directly.
+
+    Returns:
+        An entry to append to compile_commands.
+
+    Raises:
+        ValueError: Could not find the extracted file based on relative_path and
+            root_directory or file_directory.
+    """
+    # The .cmd files are intended to be included directly by Make, so they
+    # escape the pound sign '#', either as '\#' or '$(pound)' (depending on the
+    # kernel version). The compile_commands.json file is not interepreted
+    # by Make, so this code replaces the escaped version with '#'.
+    prefix = command_prefix.replace('\#', '#').replace('$(pound)', '#')
+
+    exists = path_cache.exists if path_cache is not None else os.path.exists
+
+    cur_dir = root_directory
+    expected_path = os.path.join(cur_dir, relative_path)
+    if not exists(expected_path):
+        # Try using file_directory instead. Some of the tools have a different
+        # style of .cmd file than the kernel.
+        cur_dir = file_directory
+        expected_path = os.path.join(cur_dir, relative_path)
+        if not exists(expected_path):
+            raise ValueError('File %s not in %s or %s' %
+                             (relative_path, root_directory, file_directory))
+    return {
+        'directory': cur_dir,
+        'file': relative_path,
+        'command': prefix + relative_path,
+    }
+
+
+def entry_source(entry):
+    """Returns the normalized absolute path of an entry's source file."""
+    return os.path.normpath(os.path.join(entry['directory'], entry['file']))
+
+
+def parse_cmd_file(root_directory, file_directory, filepath, path_cache=None):
+    """Parses one .cmd file into compile_commands entries.
+
+    Args:
+        root_directory: The directory that was searched for .cmd files.
+        file_directory: The path to the directory the .cmd file was found in.
+        filepath: The path to the .cmd file itself.
+        path_cache: The PathCache passed on to process_line().
+
+    Returns:
+        A list of entries, in the order their lines appear in the file.
+    """
+    line_matcher = re.compile(_LINE_PATTERN)
+
+    entries = []
+    with open(filepath, 'rt') as f:
+        for line in f:
+            result = line_matcher.match(line)
+            if not result:
+                continue
+
+            try:
+                entries.append(process_line(root_directory, file_directory,
+                                            result.group(1), result.group(2),
+                                            path_cache))
+            except ValueError as err:
+                logging.info('Could not add line from %s: %s', filepath, err)
+    return entries
+
+
+def parse_cmd_deps(filepath):
+    """Reads the source_ and deps_ sections of a .cmd file.
+
+    fixdep writes the prerequisites of every object into its .cmd file:
+
+        source_init/main.o := init/main.c
+        deps_init/main.o := \\
+            $(wildcard include/config/INIT_ENV_ARG_LIMIT) \\
+          include/linux/compiler-version.h \\
+
+    Files inside $(wildcard ...) only count if they exist.
+
+    Returns:
+        A dict of target -> (required, optional) lists of paths, as written in
+        the file and relative to the directory make ran in.
+    """
+    deps_matcher = re.compile(_DEPS_PATTERN)
+    wildcard_matcher = re.compile(_WILDCARD_PATTERN)
+
+    sections = {}
+    current = None
+    with open(filepath, 'rt') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if current is None:
+                result = deps_matcher.match(line)
+                if not result:
+                    continue
+                required, optional = sections.setdefault(result.group(2),
+                                                         ([], []))
+                line = result.group(3)
+                current = required, optional
+            for wildcard, path in wildcard_matcher.findall(line):
+                if wildcard:
+                    current[1].append(wildcard)
+                elif path != '\\':
+                    current[0].append(path)
+            if not line.endswith('\\'):
+                current = None
+    return sections
+
+
+def scan_subtree(root_directory, top, filenames=None, path_cache=None):
+    """Finds and parses the .cmd files below one part of the tree.
+
+    Args:
+        root_directory: The directory that was searched for .cmd files.
+        top: The directory to scan.
+        filenames: If given, only scan these files directly inside top and do
+            not descend into its subdirectories.
+        path_cache: The PathCache passed on to process_line().
+
+    Yields:
+        Entries in the same order a plain os.walk(top) visits them.
+    """
+    filename_matcher = re.compile(_FILENAME_PATTERN)
+
+    if filenames is None:
+        walk = os.walk(top)
+    else:
+        walk = [(top, [], filenames)]
+
+    for dirpath, _, names in walk:
+        for filename in names:
+            if not filename_matcher.match(filename):
+                continue
+            filepath = os.path.join(dirpath, filename)
+            for entry in parse_cmd_file(root_directory, dirpath, filepath,
+                                        path_cache):
+                yield entry
+
+
+def list_cmd_files(directory):
+    """Lists the .cmd files of the tree without reading them.
+
+    Yields:
+        (dirpath, filepath) tuples in os.walk() order.
+    """
+    filename_matcher = re.compile(_FILENAME_PATTERN)
+
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            if filename_matcher.match(filename):
+                yield dirpath, os.path.join(dirpath, filename)
+
+
+def walk_cmd_files(directory):
+    """Lists and stat()s the .cmd files of the tree without reading them.
+
+    Yields:
+        (dirpath, filepath, mtime_ns, size) tuples in os.walk() order.
+    """
+    for dirpath, filepath in list_cmd_files(directory):
+        try:
+            st = os.stat(filepath)
+        except OSError as err:
+            logging.info('Could not stat %s: %s', filepath, err)
+            continue
+        yield dirpath, filepath, st.st_mtime_ns, st.st_size
+
+
+def _init_worker(log_level):
+    """Sets up logging in a scanning worker process."""
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=log_level)
+
+
+def scan_tree(directory, jobs=1, log_level=logging.WARNING, path_cache=None):
+    """Collects the compile_commands entries of every .cmd file in the tree.
+
+    Args:
+        directory: The directory to search for .cmd files.
+        jobs: The number of worker processes. With more than one job the tree
+            is walked here and its .cmd files are parsed _PARSE_BATCH at a
+            time, in evenly sized runs of neighbouring files spread over the
+            workers, see parse_cmd_files().
+        log_level: The logging level to set up in worker processes.
+        path_cache: A PathCache for the existence checks. Worker processes use
+            their own caches and only their statistics are added to this one.
+
+    Yields:
+        The entries, in the same order for any number of jobs.
+    """
+    if path_cache is None:
+        path_cache = PathCache()
+
+    if jobs <= 1:
+        for entry in scan_subtree(directory, directory, None, path_cache):
+            yield entry
+        return
+
+    cmd_files = list_cmd_files(directory)
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, initializer=_init_worker,
+            initargs=(log_level,)) as executor:
+        while True:
+            batch = list(itertools.islice(cmd_files, _PARSE_BATCH))
+            if not batch:
+                break
+            for entries in parse_cmd_files(directory, batch, jobs, log_level,
+                                           path_cache, executor):
+                for entry in entries:
+                    yield entry
+
+
+def _parse_chunk(root_directory, cmd_files):
+    """Parses (dirpath, filepath) pairs in a worker process.
+
+    Returns:
+        A list with the entries of each file and the lookups and listings of
+        the PathCache used for them.
+    """
+    path_cache = PathCache()
+    parsed = [parse_cmd_file(root_directory, dirpath, filepath, path_cache)
+              for dirpath, filepath in cmd_files]
+    return parsed, path_cache.lookups, path_cache.listings
+
+
+def parse_cmd_files(root_directory, cmd_files, jobs=1,
+                    log_level=logging.WARNING, path_cache=None,
+                    executor=None):
+    """Parses (dirpath, filepath) pairs, in a process pool if jobs > 1.
+
+    Args:
+        executor: A ProcessPoolExecutor set up with _init_worker() to use,
+            instead of starting one for these files only.
+
+    Returns:
+        A list with the entries of each file, in the order of cmd_files.
+    """
+    if jobs <= 1 or len(cmd_files) <= 1:
+        return [parse_cmd_file(root_directory, dirpath, filepath, path_cache)
+                for dirpath, filepath in cmd_files]
+    if executor is None:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs, initializer=_init_worker,
+                initargs=(log_level,)) as executor:
+            return parse_cmd_files(root_directory, cmd_files, jobs,
+                                   log_level, path_cache, executor)
+
+    # Hand out runs of neighbouring files so that each worker's PathCache
+    # still sees most of the directories it lists more than once.
+    size = max(1, len(cmd_files) // (jobs * 8))
+    chunks = [cmd_files[i:i + size] for i in range(0, len(cmd_files), size)]
+    parsed = []
+    roots = [root_directory] * len(chunks)
+    for entries, lookups, listings in executor.map(_parse_chunk, roots,
+                                                   chunks):
+        if path_cache is not None:
+            path_cache.add_stats(lookups, listings)
+        parsed.extend(entries)
+    return parsed
+
+
+class CmdIndex(object):
+    """A sqlite index of .cmd files and the entries parsed from them.
+
+    Each .cmd file is stored with the mtime and size it had when it was
+    parsed, so unchanged files can be served from the index instead of being
+    read and matched again. A second table maps every source file to the
+    .cmd files that compile it, which makes looking up the command of a
+    single file independent of the size of the tree.
+
+    The index is only valid for the root directory it was built for and is
+    silently reset if that changes.
+    """
+
+    def __init__(self, path, root_directory):
+        self.path = path
+        self.root_directory = root_directory
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta '
+                        '(key TEXT PRIMARY KEY, value TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS cmd_files '
+                        '(path TEXT PRIMARY KEY, mtime_ns INTEGER, '
+                        'size INTEGER, entries TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS sources '
+                        '(source TEXT, cmd_path TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS sources_source '
+                        'ON sources (source)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS sources_cmd_path '
+                        'ON sources (cmd_path)')
+        meta = dict(self.db.execute('SELECT key, value FROM meta'))
+        if (meta.get('version') != str(_INDEX_VERSION) or
+                meta.get('root_directory') != root_directory):
+            if meta:
+                logging.info('Discarding stale index %s', path)
+            self.db.execute('DELETE FROM cmd_files')
+            self.db.execute('DELETE FROM sources')
+            self.db.executemany(
+                'INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                [('version', str(_INDEX_VERSION)),
+                 ('root_directory', root_directory)])
+            self.db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def load(self, top=None):
+        """Returns a dict of path -> (mtime_ns, size).
+
+        The entries are left in the database, see entries().
+
+        Args:
+            top: Only return the .cmd files below this directory, or None for
+                the whole index.
+        """
+        query = 'SELECT path, mtime_ns, size FROM cmd_files'
+        if top is None or os.path.normpath(top) == self.root_directory:
+            rows = self.db.execute(query)
+        else:
+            # Every path below top sorts between top + '/' and top + '0'.
+            top = os.path.normpath(top)
+            rows = self.db.execute(
+                query + ' WHERE path > ? AND path < ?',
+                (top + os.sep, top + chr(ord(os.sep) + 1)))
+        return {row[0]: row[1:] for row in rows}
+
+    def entries(self, path):
+        """Returns the entries stored for a .cmd file."""
+        row = self.db.execute('SELECT entries FROM cmd_files WHERE path = ?',
+                              (path,)).fetchone()
+        return json.loads(row[0])
+
+    def update(self, changed, removed):
+        """Stores re-parsed .cmd files and forgets deleted ones.
+
+        Args:
+            changed: An iterable of (path, mtime_ns, size, entries) tuples.
+            removed: An iterable of .cmd paths that no longer exist.
+        """
+        changed = list(changed)
+        stale = [(path,) for path in removed]
+        stale.extend((path,) for path, _, _, _ in changed)
+        with self.db:
+            self.db.executemany('DELETE FROM cmd_files WHERE path = ?', stale)
+            self.db.executemany('DELETE FROM sources WHERE cmd_path = ?',
+                                stale)
+            self.db.executemany(
+                'INSERT INTO cmd_files VALUES (?, ?, ?, ?)',
+                [(path, mtime_ns, size, json.dumps(entries))
+                 for path, mtime_ns, size, entries in changed])
+            self.db.executemany(
+                'INSERT INTO sources VALUES (?, ?)',
+                [(entry_source(entry), path)
+                 for path, _, _, entries in changed for entry in entries])
+
+    def refresh(self, top, jobs=1, log_level=logging.WARNING,
+                path_cache=None):
+        """Brings the index up to date for a directory and returns its entries.
+
+        The directory is walked and its .cmd files are stat()ed, but only new
+        or changed files are read. Files that disappeared are dropped.
+
+        Only the mtime and size of the indexed files are held in memory. The
+        tree is handled _PARSE_BATCH .cmd files at a time: the changed ones
+        are parsed, their entries yielded along with those of the unchanged
+        ones read back from the index, and written to the index before the
+        next batch.
+
+        Args:
+            top: The directory to refresh, the root directory or below it.
+            jobs: The number of worker processes used for changed files.
+            log_level: The logging level to set up in worker processes.
+            path_cache: A PathCache for the existence checks, as for
+                scan_tree().
+
+        Yields:
+            The entries of top, identical to what scan_tree(top) would
+            produce. The files that disappeared are only dropped from the
+            index once all entries have been consumed.
+        """
+        known = self.load(top)
+        cmd_files = walk_cmd_files(top)
+
+        total = reread = 0
+        while True:
+            batch = list(itertools.islice(cmd_files, _PARSE_BATCH))
+            if not batch:
+                break
+            stale = []
+            for dirpath, filepath, mtime_ns, size in batch:
+                if known.get(filepath) != (mtime_ns, size):
+                    stale.append((dirpath, filepath))
+            parsed = dict(zip(
+                [filepath for _, filepath in stale],
+                parse_cmd_files(self.root_directory, stale, jobs, log_level,
+                                path_cache)))
+
+            changed = []
+            for _, filepath, mtime_ns, size in batch:
+                known.pop(filepath, None)
+                if filepath in parsed:
+                    entries = parsed[filepath]
+                    changed.append((filepath, mtime_ns, size, entries))
+                else:
+                    entries = self.entries(filepath)
+                for entry in entries:
+                    yield entry
+            self.update(changed, ())
+            total += len(batch)
+            reread += len(changed)
+        # Whatever was not walked past no longer exists.
+        removed = list(known)
+
+        logging.info('Index %s: %d .cmd files in %s, %d re-read, %d removed',
+                     self.path, total, top, reread, len(removed))
+        self.update((), removed)
+
+    def find(self, source, path_cache=None):
+        """Returns the entries that compile one source file.
+
+        Only the .cmd files already recorded for the source are checked, and
+        re-read if they changed. A source the index has never seen yields an
+        empty list; refresh() its directory to pick it up.
+
+        Args:
+            source: The path of the source file.
+            path_cache: The PathCache passed on to process_line().
+        """
+        source = os.path.normpath(os.path.abspath(source))
+        cmd_paths = [row[0] for row in self.db.execute(
+            'SELECT DISTINCT cmd_path FROM sources WHERE source = ?',
+            (source,))]
+
+        found = []
+        changed = []
+        removed = []
+        for cmd_path in cmd_paths:
+            row = self.db.execute(
+                'SELECT mtime_ns, size, entries FROM cmd_files '
+                'WHERE path = ?', (cmd_path,)).fetchone()
+            try:
+                st = os.stat(cmd_path)
+            except OSError:
+                removed.append(cmd_path)
+                continue
+            if row is not None and row[:2] == (st.st_mtime_ns, st.st_size):
+                entries = json.loads(row[2])
+            else:
+                entries = parse_cmd_file(self.root_directory,
+                                         os.path.dirname(cmd_path), cmd_path,
+                                         path_cache)
+                changed.append((cmd_path, st.st_mtime_ns, st.st_size,
+                                entries))
+            found.extend(entry for entry in entries
+                         if entry_source(entry) == source)
+        if changed or removed:
+            self.update(changed, removed)
+        return found
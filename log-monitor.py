@@ -22,102 +22,1009 @@ import os
 import sys
 import time
 import json
-import requests
+import re
+import random
+import queue
+import select
+import signal
+import threading
+import struct
+import bisect
+import ctypes
+import ctypes.util
+import collections
+import http.server
 import click
-import importlib
-import traceback
 import logging
+
+try:
+    import re._parser as sre_parse
+except ImportError:
+    import sre_parse
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 import logging.handlers
 
-class FsBot:
-    def __init__(self, name, apikey):
-        self.name = name
-        self.apikey = apikey
-        pass
-
-    def send_notify(self, title, msg, run=True):
-        click.echo("send notify to %s msg: %s run: %s" % (self.name, msg, run))
-        # data to be sent to api
-        data = {
-            "msg_type": "post",
-            "content": {
-                "post": {
-                    "zh_cn": {
-                        "title": title,
-                        "content": [
-                            [
-                                {
-                                    "tag": "text",
-                                    "text": msg
-                                }
-                            ]
-                        ]
-                    }
-                }
-            }
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from bot_notify import notify_robot
+
+def send_email(subject, secret, logs):
+        notify_robot(['FsBot'], ['default'], secret, subject, logs)
+        print("Get error")
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0o2000000)
+
+_EVENT = struct.Struct('iIII')
+
+
+class Inotify:
+    """Minimal inotify binding on top of libc, through ctypes."""
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                 use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def read(self, timeout):
+        """Waits up to timeout seconds for events.
+
+        Returns:
+            A list of (wd, mask, name) tuples, empty on timeout.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, pos)
+            pos += _EVENT.size
+            name = data[pos:pos + length].rstrip(b'\0')
+            pos += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LogFollower:
+    """Follows one log file like tail -F.
+
+    The file is reopened when it is rotated, i.e. its path refers to another
+    inode, after whatever was left in the old file is read. It is read again
+    from the start when it is truncated, and waited for while it is missing.
+
+    With a checkpoint, reading resumes where it was taken. If the file was
+    rotated since, the rest of the old file is read first, provided it is
+    still in the same directory under a name starting with the file name,
+    like syslog.1.
+    """
+
+    BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, path, from_end=True, checkpoint=None):
+        self.path = path
+        self.file = None
+        self.inode = None
+        self.pos = 0
+        self.consumed = 0
+        self.partial = b''
+        if checkpoint is None or not self._resume(checkpoint):
+            self._open(from_end)
+
+    def _open(self, from_end=False, path=None, offset=0):
+        try:
+            f = open(path or self.path, 'rb')
+        except OSError:
+            return False
+        if self.file is not None:
+            self.file.close()
+        self.file = f
+        st = os.fstat(f.fileno())
+        self.inode = (st.st_dev, st.st_ino)
+        self.pos = st.st_size if from_end else min(offset, st.st_size)
+        f.seek(self.pos)
+        self.consumed = self.pos
+        self.partial = b''
+        return True
+
+    def _resume(self, checkpoint):
+        inode = (checkpoint['dev'], checkpoint['inode'])
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            st = None
+        if st is not None and (st.st_dev, st.st_ino) == inode:
+            # A shorter file was truncated meanwhile, read it all.
+            offset = checkpoint['offset']
+            return self._open(offset=offset if offset <= st.st_size else 0)
+        rotated = self._find_rotated(inode)
+        if rotated is not None:
+            return self._open(path=rotated, offset=checkpoint['offset'])
+        # Everything in the current file was written after the rotation.
+        return self._open()
+
+    def _find_rotated(self, inode):
+        directory, name = os.path.split(self.path)
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            return None
+        for entry in entries:
+            if not entry.name.startswith(name) or entry.name == name:
+                continue
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) == inode:
+                return entry.path
+        return None
+
+    def checkpoint(self):
+        """Returns where to resume from, after the last line handled."""
+        if self.file is None:
+            return None
+        return {
+            'dev': self.inode[0],
+            'inode': self.inode[1],
+            'offset': self.consumed,
         }
 
-        from pprint import pprint
-        pprint(data)
-        if not run:
+    def _read(self):
+        if self.file is None:
             return
+        if os.fstat(self.file.fileno()).st_size < self.pos:
+            # Truncated, e.g. by copytruncate.
+            self.file.seek(0)
+            self.pos = 0
+            self.consumed = 0
+            self.partial = b''
+        # Read block by block, so that a long backlog is replayed quickly
+        # without holding it all in memory.
+        while True:
+            data = self.file.read(self.BLOCK_SIZE)
+            if not data:
+                return
+            self.pos += len(data)
+            data = self.partial + data
+            lines = data.split(b'\n')
+            self.partial = lines.pop()
+            for line in lines:
+                yield line.decode('utf-8', 'replace')
+                # Only counted once the caller asks for the next line, so
+                # that a line it did not get through is read again.
+                self.consumed += len(line) + 1
 
-        server = "https://open.feishu.cn/open-apis/bot/v2/hook/" + \
-            self.apikey
+    def poll(self):
+        """Yields the lines completed since the last poll."""
+        yield from self._read()
         try:
+            st = os.stat(self.path)
+        except OSError:
+            return
+        if (st.st_dev, st.st_ino) != self.inode and self._open():
+            yield from self._read()
 
-            print('server: %s' % (server))
-            r = requests.post(url = server, data = json.dumps(data),
-                          headers = {'Content-Type': 'application/json'})
-            click.echo("Notify feishu server, status: {}".format(r.status_code))
-            return True
-        except requests.exceptions.ConnectionError as e:
-            click.echo("Notify feishu server failed".format(r.status_code))
-            traceback.print_exception(*sys.exc_info())
 
-        return False
+class LogWatcher:
+    """Follows many log files, woken up by inotify when it is available.
 
-NotifyBots = [FsBot]
+    The directories of the files are watched rather than the files, so that
+    created, moved and rotated files are noticed as well. Without inotify, or
+    with poll=True, the files are polled every interval seconds. With
+    inotify, every file is still checked each interval, in case an event
+    was lost.
 
-def str_to_class(module_name, class_name):
-    """Return a class instance from a string reference"""
-    try:
-        module_ = importlib.import_module(module_name)
+    With a checkpoint file, the position in every file is saved there each
+    checkpoint_interval seconds and on exit, and following resumes from it:
+    lines written while the watcher was not running are read first, before
+    waiting for new ones.
+    """
+
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CREATE | IN_MOVED_FROM | IN_MOVED_TO |
+            IN_DELETE)
+
+    def __init__(self, paths, interval=1.0, poll=False, checkpoint=None,
+                 checkpoint_interval=5.0):
+        self.interval = interval
+        self.checkpoint_path = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        checkpoints = self._load_checkpoints()
+        self.followers = []
+        for path in paths:
+            path = os.path.abspath(path)
+            self.followers.append(LogFollower(path,
+                                              checkpoint=checkpoints.get(path)))
+        self.inotify = None
+        self.watches = {}
+        self.polled = time.monotonic()
+        if poll:
+            return
         try:
-            class_ = getattr(module_, class_name)
-        except AttributeError:
-            logging.error('Class does not exist')
-    except ImportError:
-        logging.error('Module does not exist')
-    return class_ or None
+            self.inotify = Inotify()
+            for follower in self.followers:
+                directory, name = os.path.split(follower.path)
+                if directory not in self.watches.values():
+                    wd = self.inotify.add_watch(directory, self.MASK)
+                    self.watches[wd] = directory
+        except (OSError, AttributeError, TypeError) as e:
+            logging.warning('inotify unavailable, polling: %s', e)
+            if self.inotify is not None:
+                self.inotify.close()
+            self.inotify = None
+            self.watches = {}
 
-def notify_robot(bottype, secret = None, title = 'Title', message = 'Message', run = True):
-    """send notify to chat robot"""
+    def _load_checkpoints(self):
+        if self.checkpoint_path is None:
+            return {}
+        try:
+            with open(self.checkpoint_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.warning('Ignoring checkpoint %s: %s', self.checkpoint_path,
+                            e)
+            return {}
 
-    _class = str_to_class(__name__, bottype)
+    def save_checkpoints(self):
+        if self.checkpoint_path is None:
+            return
+        checkpoints = {}
+        for follower in self.followers:
+            checkpoint = follower.checkpoint()
+            if checkpoint is not None:
+                checkpoints[follower.path] = checkpoint
+        with open(self.checkpoint_path + '.tmp', 'w') as f:
+            json.dump(checkpoints, f, indent=2)
+        os.replace(self.checkpoint_path + '.tmp', self.checkpoint_path)
 
-    bot = _class(bottype, secret)
-    return bot.send_notify(title, message, run)
+    def _changed(self):
+        """Waits for some of the files to change and returns them.
 
+        Every follower is returned at least once per interval, even while
+        events keep coming for other files, so that changes inotify misses
+        (files on NFS, directories replaced under us) are still picked up.
+        """
+        if self.inotify is None:
+            time.sleep(self.interval)
+            return self.followers
+        timeout = max(0, self.polled + self.interval - time.monotonic())
+        events = self.inotify.read(timeout)
+        now = time.monotonic()
+        if (now - self.polled >= self.interval or
+                any(mask & IN_Q_OVERFLOW for _, mask, _ in events)):
+            self.polled = now
+            return self.followers
+        paths = {os.path.join(self.watches.get(wd, ''), name)
+                 for wd, mask, name in events}
+        return [follower for follower in self.followers
+                if follower.path in paths]
 
-def send_email(subject, secret, logs):
-        notify_robot('FsBot', secret, subject, logs)
-        print("Get error")
+    def run(self, handler):
+        """Calls handler(path, line) for every new line, forever."""
+        saved = time.monotonic()
+        # Catch up with what was written since the checkpoint first.
+        changed = self.followers
+        try:
+            while True:
+                for follower in changed:
+                    for line in follower.poll():
+                        handler(follower.path, line)
+                if time.monotonic() - saved >= self.checkpoint_interval:
+                    self.save_checkpoints()
+                    saved = time.monotonic()
+                changed = self._changed()
+        finally:
+            self.save_checkpoints()
+
+
+class Rule:
+    """A named literal or regular expression to look for in log lines."""
+
+    def __init__(self, name, pattern, regex=False, flags=''):
+        self.name = name
+        self.pattern = pattern
+        self.regex = regex
+        self.flags = flags
+        if regex:
+            # Fail early, with the rule in the message.
+            try:
+                re.compile(self.expression())
+            except re.error as e:
+                raise ValueError('rule {:s}: {:s}'.format(name, str(e)))
+
+    def expression(self):
+        if not self.regex:
+            return re.escape(self.pattern)
+        if self.flags:
+            return '(?{:s}:{:s})'.format(self.flags, self.pattern)
+        return self.pattern
+
+
+def load_rules(path):
+    """Loads a rule file.
+
+    Every line is "name: pattern", where the pattern is a literal, or a
+    regular expression when written as /regex/ or /regex/flags with flags
+    among "aiLmsux". Empty lines and lines starting with # are skipped.
+    """
+    rules = []
+    with open(path) as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            name, sep, pattern = line.partition(':')
+            pattern = pattern.strip()
+            if not sep or not name.strip() or not pattern:
+                raise ValueError('{:s}:{:d}: expected "name: pattern"'.format(
+                    path, lineno))
+            obj = re.fullmatch(r'/(.*)/([aiLmsux]*)', pattern)
+            if obj is not None:
+                rules.append(Rule(name.strip(), obj.group(1), True,
+                                  obj.group(2)))
+            else:
+                rules.append(Rule(name.strip(), pattern))
+    return rules
+
+
+def _trie_expression(node):
+    """Turns a trie of dicts into a regex matching its words, longest first.
+
+    The '' key marks the end of a word.
+    """
+    end = '' in node
+    branches = [re.escape(char) + _trie_expression(child)
+                for char, child in sorted(node.items()) if char]
+    if not branches:
+        return ''
+    if len(branches) == 1 and not end:
+        return branches[0]
+    expression = '(?:' + '|'.join(branches) + ')'
+    return expression + '?' if end else expression
+
+
+def required_literal(rule):
+    """Returns the longest literal every match of a regex rule contains.
+
+    Only literals at the top level of the pattern qualify, since anything
+    inside a group, an alternation or a repeat may be skipped. Returns ''
+    when there is none, or the rule ignores case.
+    """
+    flags = 0
+    for letter in rule.flags:
+        flags |= getattr(re, letter.upper())
+    if flags & re.IGNORECASE:
+        return ''
+    parsed = sre_parse.parse(rule.pattern, flags)
+    if parsed.state.flags & re.IGNORECASE:
+        return ''
+    best = run = ''
+    for op, av in parsed:
+        if op == sre_parse.LITERAL:
+            run += chr(av)
+            continue
+        best = max(best, run, key=len)
+        run = ''
+    return max(best, run, key=len)
+
+
+class RuleMatcher:
+    """Matches lines against many literal and regex rules at once.
+
+    Every rule is decided on its own, so overlapping matches and matches
+    inside other matches are all reported, and the regex rules are compiled
+    one by one, so their groups do not clash.
+
+    Most lines match no rule, and the cost of telling so is what matters.
+    The literal rules, and the regex rules with a literal every match must
+    contain, are found with one scan of the line for all those literals:
+    - with the ahocorasick module (pyahocorasick) installed, by an
+      Aho-Corasick automaton, which reports every literal in the line. Its
+      scan costs about the same for any number of literals, so even regex
+      rules with a literal of a single character are indexed by it;
+    - otherwise by one regex of the trie of the literals, searched again
+      from the character after each match. A match is the longest literal
+      starting there, and the literals it starts with are looked up, so
+      every literal in the line is found with one search per occurrence.
+      Its cost still grows slowly with the number of literals, and only
+      literals of MIN_LITERAL characters or more are indexed.
+    A regex rule is only searched for when its literal is in the line.
+
+    Regex rules without such a literal are searched for with one alternation
+    of those without capturing groups, and one search each for the others,
+    so their cost grows with their number.
+    """
+
+    MIN_LITERAL = 3
+
+    def __init__(self, rules, engine=None):
+        self.rules = list(rules)
+        self.engine = engine or ('ahocorasick' if ahocorasick else 'regex')
+        min_literal = 1 if self.engine == 'ahocorasick' else self.MIN_LITERAL
+        self.literals = {}
+        self.fallback = []
+        for index, rule in enumerate(self.rules):
+            if not rule.regex:
+                self.literals.setdefault(rule.pattern, []).append(
+                    (index, None))
+                continue
+            regex = re.compile(rule.expression())
+            literal = required_literal(rule)
+            if len(literal) >= min_literal:
+                self.literals.setdefault(literal, []).append((index, regex))
+            else:
+                self.fallback.append((index, regex))
+
+        self.automaton = None
+        self.literal_pattern = None
+        if self.literals and self.engine == 'ahocorasick':
+            self.automaton = ahocorasick.Automaton()
+            for literal, candidates in self.literals.items():
+                self.automaton.add_word(literal, candidates)
+            self.automaton.make_automaton()
+        elif self.literals:
+            trie = {}
+            for literal in self.literals:
+                node = trie
+                for char in literal:
+                    node = node.setdefault(char, {})
+                node[''] = literal
+            self.literal_pattern = re.compile(_trie_expression(trie))
+            # The candidates of every literal that starts a literal.
+            self.prefixes = {}
+            for literal in self.literals:
+                node = trie
+                prefixes = []
+                for char in literal:
+                    node = node[char]
+                    if '' in node:
+                        prefixes.append(self.literals[node['']])
+                self.prefixes[literal] = prefixes
+
+        # User groups would clash or be renumbered in a joined pattern.
+        joinable = [self.rules[index].expression()
+                    for index, regex in self.fallback if regex.groups == 0]
+        self.fallback_pattern = None
+        if joinable:
+            self.fallback_pattern = re.compile(
+                '|'.join('(?:{:s})'.format(expression)
+                         for expression in joinable))
+
+    def _literal_hits(self, line):
+        if self.automaton is not None:
+            found = {id(candidates): candidates
+                     for end, candidates in self.automaton.iter(line)}
+        elif self.literal_pattern is not None:
+            found = {}
+            search = self.literal_pattern.search
+            obj = search(line)
+            while obj is not None:
+                for candidates in self.prefixes[obj.group()]:
+                    found[id(candidates)] = candidates
+                obj = search(line, obj.start() + 1)
+        else:
+            return []
+        return [index for candidates in found.values()
+                for index, regex in candidates
+                if regex is None or regex.search(line)]
 
-def monitor_log(log_file):
-    with open(log_file, 'r') as f:
-        f.seek(0, 2)  # Go to the end of the file
+    def match(self, line):
+        """Returns the names of the rules matching line, in rule order."""
+        hits = self._literal_hits(line)
+        if self.fallback:
+            check = (self.fallback_pattern is None or
+                     self.fallback_pattern.search(line) is not None)
+            hits += [index for index, regex in self.fallback
+                     if (regex.groups or check) and regex.search(line)]
+        if not hits:
+            return []
+        names = []
+        for index in sorted(hits):
+            name = self.rules[index].name
+            if name not in names:
+                names.append(name)
+        return names
+
+
+def benchmark(counts=(10, 100, 1000), lines=100000, seed=1):
+    """Prints how many lines per second RuleMatcher handles per rule count.
+
+    The lines are random words, and the rules random lowercase words and
+    phrases from the same alphabet, so the first characters of the rules
+    tell nothing about a line. One line in a thousand contains a rule. The
+    mixed rule sets make one rule in four a regex, of which one in four only
+    has a single character literal, which only the automaton indexes.
+    """
+    rand = random.Random(seed)
+    alphabet = 'abcdefghijklmnopqrstuvwxyz'
+
+    def word(length):
+        return ''.join(rand.choice(alphabet) for _ in range(length))
+
+    vocabulary = [word(rand.randint(3, 9)) for _ in range(2000)]
+    text = [' '.join(rand.choice(vocabulary) for _ in range(12))
+            for _ in range(lines)]
+
+    def rule_set(count, regexes):
+        # The same rules for every engine.
+        rand.seed(seed + count)
+        rules = []
+        hits = []
+        for i in range(count):
+            name = 'rule{:d}'.format(i)
+            if regexes and i % 4 == 3:
+                if i % 16 == 15:
+                    rules.append(Rule(name, r'[a-z]{{{:d}}}=[0-9]+'.format(
+                        2 + i % 7), True))
+                    hits.append('{:s}={:d}'.format(word(2 + i % 7), i))
+                else:
+                    phrase = word(6)
+                    rules.append(Rule(name, phrase + r' \d+ ' + word(4),
+                                      True))
+                    hits.append('{:s} 42 {:s}'.format(
+                        phrase, rules[-1].pattern[-4:]))
+            else:
+                phrase = word(rand.randint(4, 10))
+                if i % 2:
+                    phrase += ' ' + word(rand.randint(3, 8))
+                rules.append(Rule(name, phrase))
+                hits.append(phrase)
+        return rules, hits
+
+    engines = ['regex'] + (['ahocorasick'] if ahocorasick else [])
+    for engine in engines:
+        click.echo('{:s}:'.format(engine))
+        click.echo('{:>8s}{:>16s}{:>16s}{:>16s}'.format(
+            'rules', 'literal', 'mixed', 'matches'))
+        for count in counts:
+            rates = []
+            for regexes in (False, True):
+                rules, hits = rule_set(count, regexes)
+                samples = list(text)
+                for i in range(0, lines, 1000):
+                    samples[i] = samples[i] + ' ' + hits[i // 1000 % count]
+                matcher = RuleMatcher(rules, engine)
+                start = time.perf_counter()
+                matches = sum(1 for line in samples if matcher.match(line))
+                rates.append(lines / (time.perf_counter() - start))
+            click.echo('{:>8d}{:>16.0f}{:>16.0f}{:>16d}'.format(
+                count, rates[0], rates[1], matches))
+
+
+_VOLATILE_PATTERN = re.compile(r'0x[0-9a-fA-F]+|\d+')
+
+
+def fingerprint(names, line):
+    """Identifies repeats of an event, ignoring numbers like times and PIDs."""
+    return (tuple(names), _VOLATILE_PATTERN.sub('#', line))
+
+
+class AlertBatcher:
+    """Sends alerts from a thread of its own, batched and deduplicated.
+
+    submit() never blocks: alerts go to a bounded queue, and are counted as
+    dropped when it is full. The sender thread sends at most one message per
+    window seconds. An alert after a quiet window goes out right away, the
+    ones following it are collected until the window is over. Alerts with
+    the same fingerprint are sent once, with their count and a few sample
+    lines.
+    """
+
+    def __init__(self, send, window=10.0, max_queue=10000, samples=3):
+        self.send = send
+        self.window = window
+        self.samples = samples
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.last_sent = None
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, path, names, line):
+        """Queues an alert, returns False if it was dropped."""
+        try:
+            self.queue.put_nowait((path, names, line))
+            return True
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+
+    def close(self):
+        """Sends what is queued and stops the sender thread."""
+        self.queue.put(None)
+        self._thread.join()
+
+    def _collect(self, deadline, batch):
+        """Adds alerts to batch until deadline, returns False on close().
+
+        Without a deadline, returns after the first alert.
+        """
         while True:
-            line = f.readline()
-            if not line:
-                time.sleep(1)
+            try:
+                if deadline is None:
+                    alert = self.queue.get()
+                else:
+                    timeout = deadline - time.monotonic()
+                    if timeout > 0:
+                        alert = self.queue.get(timeout=timeout)
+                    else:
+                        alert = self.queue.get_nowait()
+            except queue.Empty:
+                return True
+            if alert is None:
+                return False
+            path, names, line = alert
+            key = fingerprint(names, line)
+            entry = batch.get(key)
+            if entry is None:
+                entry = batch[key] = [0, set(), []]
+            entry[0] += 1
+            entry[1].add(path)
+            if len(entry[2]) < self.samples:
+                entry[2].append(line)
+            if deadline is None:
+                return True
+
+    def _run(self):
+        running = True
+        while running:
+            batch = {}
+            # Block until there is something to send.
+            running = self._collect(None, batch)
+            if running and self.last_sent is not None:
+                running = self._collect(self.last_sent + self.window, batch)
+            with self._lock:
+                dropped, self.dropped = self.dropped, 0
+            if batch or dropped:
+                self._flush(batch, dropped)
+
+    def _flush(self, batch, dropped):
+        total = sum(entry[0] for entry in batch.values())
+        title = "{:d} alerts in log files".format(total)
+        parts = []
+        for (names, _), (count, paths, samples) in batch.items():
+            parts.append("{:d} x {:s} in {:s}:\n{:s}".format(
+                count, ', '.join(names), ', '.join(sorted(paths)),
+                '\n'.join(samples)))
+        if dropped:
+            parts.append("{:d} alerts dropped, the queue was full".format(
+                dropped))
+        self.last_sent = time.monotonic()
+        try:
+            self.send(title, '\n\n'.join(parts))
+        except Exception:
+            logging.exception('Failed to send alerts')
+
+
+LogRecord = collections.namedtuple('LogRecord',
+                                   ['format', 'time', 'level', 'tag',
+                                    'message'])
+
+# Syslog severities, also used by the kernel log levels.
+SEVERITIES = ['emerg', 'alert', 'crit', 'err', 'warning', 'notice', 'info',
+              'debug']
+LOGCAT_LEVELS = {'V': 'debug', 'D': 'debug', 'I': 'info', 'W': 'warning',
+                 'E': 'err', 'F': 'crit', 'S': 'info'}
+
+# [   12.345678] message, as written by dmesg, with the <level> of dmesg -r.
+DMESG_PATTERN = re.compile(r'(?:<(\d+)>)?\[\s*(\d+\.\d+)\] ?(.*)')
+# 05-19 12:34:56.789  1234  1234 E Tag     : message (threadtime), or
+# E/Tag     ( 1234): message (brief).
+LOGCAT_PATTERN = re.compile(
+    r'(\d\d-\d\d \d\d:\d\d:\d\d\.\d+)\s+\d+\s+\d+\s+([VDIWEFS])\s+'
+    r'(.*?)\s*: (.*)|([VDIWEFS])/(.*?)\s*\(\s*\d+\): (.*)')
+# <13>May 19 12:34:56 host program[1234]: message, or with an ISO 8601 time.
+SYSLOG_PATTERN = re.compile(
+    r'(?:<(\d+)>)?([A-Z][a-z]{2} [ \d]\d \d\d:\d\d:\d\d|'
+    r'\d{4}-\d\d-\d\dT\S+) \S+ ([^:\[\s]+)(?:\[\d+\])?: (.*)')
+
+
+def parse_dmesg(line):
+    obj = DMESG_PATTERN.match(line)
+    if obj is None:
+        return None
+    level, stamp, message = obj.groups()
+    # dmesg -r prints the facility too, e.g. <8> for user level 0.
+    level = SEVERITIES[int(level) & 7] if level else ''
+    return LogRecord('dmesg', stamp, level, '', message)
+
+
+def parse_logcat(line):
+    obj = LOGCAT_PATTERN.match(line)
+    if obj is None:
+        return None
+    if obj.group(1) is not None:
+        stamp, level, tag, message = obj.group(1, 2, 3, 4)
+    else:
+        stamp = ''
+        level, tag, message = obj.group(5, 6, 7)
+    return LogRecord('logcat', stamp, LOGCAT_LEVELS[level], tag, message)
+
+
+def parse_syslog(line):
+    obj = SYSLOG_PATTERN.match(line)
+    if obj is None:
+        return None
+    priority, stamp, tag, message = obj.groups()
+    level = SEVERITIES[int(priority) & 7] if priority else ''
+    return LogRecord('syslog', stamp, level, tag, message)
+
+
+PARSERS = {
+    'dmesg': parse_dmesg,
+    'logcat': parse_logcat,
+    'syslog': parse_syslog,
+}
+
+
+class LogParser:
+    """Parses lines with the parsers of some formats.
+
+    The parser that last succeeded for a file is tried first, so a file of
+    one format costs one regex match per line, whatever the number of
+    formats.
+    """
+
+    def __init__(self, formats=None):
+        self.parsers = [PARSERS[name] for name in formats or PARSERS]
+        self.last = {}
+
+    def parse(self, path, line):
+        """Returns a LogRecord, or None if no format fits the line.
+
+        A parser failing on a line is logged and counts as not fitting, so
+        that one odd line can not stop the monitor.
+        """
+        try:
+            return self._parse(path, line)
+        except Exception:
+            logging.exception('Failed to parse %r from %s', line, path)
+            return None
+
+    def _parse(self, path, line):
+        last = self.last.get(path)
+        if last is not None:
+            record = last(line)
+            if record is not None:
+                return record
+        for parser in self.parsers:
+            if parser is last:
+                continue
+            record = parser(line)
+            if record is not None:
+                self.last[path] = parser
+                return record
+        return None
+
+
+def _labels(**labels):
+    return ','.join('{:s}="{:s}"'.format(
+        name, value.replace('\\', '\\\\').replace('"', '\\"')
+        .replace('\n', '\\n')) for name, value in labels.items())
+
+
+class Metrics:
+    """Line and match counters, and a match interval histogram per rule.
+
+    Updates are a few dict operations and, for the histogram, a bisect over
+    the fixed buckets, so they take the same time for every line. They run
+    on the reader thread only. render() runs on the HTTP server thread, and
+    copies the dicts with list(), which the GIL makes atomic.
+    """
+
+    BUCKETS = (0.1, 1.0, 10.0, 60.0, 600.0, 3600.0)
+
+    def __init__(self):
+        self.lines = collections.Counter()
+        self.matches = collections.Counter()
+        self.intervals = {}
+        self.last_match = {}
+
+    def count_line(self, path, record):
+        if record is None:
+            self.lines[(path, '', '')] += 1
+        else:
+            self.lines[(path, record.format, record.level)] += 1
+
+    def count_match(self, names, now=None):
+        now = time.monotonic() if now is None else now
+        for name in names:
+            self.matches[name] += 1
+            last = self.last_match.get(name)
+            self.last_match[name] = now
+            if last is None:
                 continue
+            interval = now - last
+            histogram = self.intervals.get(name)
+            if histogram is None:
+                histogram = self.intervals[name] = [
+                    [0] * (len(self.BUCKETS) + 1), 0.0]
+            histogram[0][bisect.bisect_left(self.BUCKETS, interval)] += 1
+            histogram[1] += interval
+
+    def render(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        out = [
+            '# HELP log_monitor_lines_total Lines read, by file, format and '
+            'level.',
+            '# TYPE log_monitor_lines_total counter',
+        ]
+        for (path, fmt, level), count in sorted(list(self.lines.items())):
+            out.append('log_monitor_lines_total{{{:s}}} {:d}'.format(
+                _labels(file=path, format=fmt, level=level), count))
+        out += [
+            '# HELP log_monitor_matches_total Lines matching each rule.',
+            '# TYPE log_monitor_matches_total counter',
+        ]
+        for name, count in sorted(list(self.matches.items())):
+            out.append('log_monitor_matches_total{{{:s}}} {:d}'.format(
+                _labels(rule=name), count))
+        out += [
+            '# HELP log_monitor_match_interval_seconds Time between two '
+            'matches of a rule.',
+            '# TYPE log_monitor_match_interval_seconds histogram',
+        ]
+        for name, (counts, total) in sorted(list(self.intervals.items())):
+            counts = list(counts)
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                out.append(
+                    'log_monitor_match_interval_seconds_bucket{{{:s}}} {:d}'
+                    .format(_labels(rule=name, le=le), cumulative))
+            out.append('log_monitor_match_interval_seconds_sum{{{:s}}} {:f}'
+                       .format(_labels(rule=name), total))
+            out.append('log_monitor_match_interval_seconds_count{{{:s}}} {:d}'
+                       .format(_labels(rule=name), cumulative))
+        return '\n'.join(out) + '\n'
+
+
+def serve_metrics(metrics, address, port):
+    """Serves metrics on http://address:port/metrics from a thread."""
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((address, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def monitor_log(log_files, secret, rules, interval=1.0, poll=False,
+                window=10.0, checkpoint=None, formats=None, metrics_port=None,
+                metrics_address='127.0.0.1', quiet=False):
+    if ahocorasick is None:
+        logging.warning('pyahocorasick is not installed, matching many rules '
+                        'is slower without it')
+    matcher = RuleMatcher(rules)
+    parser = LogParser(formats)
+    metrics = Metrics()
+    alerts = AlertBatcher(lambda title, message: send_email(title, secret,
+                                                            message),
+                          window)
+    if metrics_port is not None:
+        serve_metrics(metrics, metrics_address, metrics_port)
+
+    def handler(path, line):
+        if not quiet:
             print(line)
-            if "suspend" in line:
-                send_email("Error in log file", line)
+        metrics.count_line(path, parser.parse(path, line))
+        names = matcher.match(line)
+        if names:
+            metrics.count_match(names)
+            alerts.submit(path, names, line)
+
+    def terminate(signum, frame):
+        # Unwind through the finally clauses, which save the checkpoints and
+        # flush the pending alerts, as on Ctrl-C.
+        raise SystemExit(128 + signum)
+
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        LogWatcher(log_files, interval, poll, checkpoint).run(handler)
+    finally:
+        alerts.close()
+
+@click.command()
+@click.option('-s', '--secret', help='Feishu bot secret')
+@click.option('-k', '--key-word', 'key_words', multiple=True,
+              help='Notify on lines containing KEY_WORD, may be repeated ' +
+              '(Default: suspend, without --rules)')
+@click.option('-r', '--rules', 'rule_files', multiple=True,
+              type=click.Path(exists=True, dir_okay=False),
+              help='Rule file of "name: literal" or "name: /regex/" lines, ' +
+              'may be repeated')
+@click.option('-i', '--interval', type=float, default=1.0, show_default=True,
+              help='Seconds between checks of all files')
+@click.option('--poll', is_flag=True,
+              help='Poll the files instead of using inotify')
+@click.option('-w', '--window', type=float, default=10.0, show_default=True,
+              help='Send at most one message per WINDOW seconds')
+@click.option('-c', '--checkpoint', type=click.Path(dir_okay=False),
+              help='Save the position in every file to CHECKPOINT, and ' +
+              'resume from there after a restart')
+@click.option('-f', '--format', 'formats', multiple=True,
+              type=click.Choice(list(PARSERS)),
+              help='Log formats to parse, may be repeated (Default: all)')
+@click.option('-m', '--metrics-port', type=int, default=None,
+              help='Serve Prometheus metrics on this port')
+@click.option('--metrics-address', default='127.0.0.1', show_default=True,
+              help='Address to serve the metrics on')
+@click.option('-q', '--quiet', is_flag=True,
+              help='Do not echo every line read')
+@click.option('--benchmark', 'run_benchmark', is_flag=True,
+              help='Measure the rule matcher with 10, 100 and 1000 rules')
+@click.argument('log_files', nargs=-1)
+def monitor_log_cli(secret, key_words, rule_files, interval, poll, window,
+                    checkpoint, formats, metrics_port, metrics_address, quiet,
+                    run_benchmark, log_files):
+    """Follow LOG_FILES like tail -F and notify on rule matches.
+
+    Install pyahocorasick for many rules, it keeps the cost of matching a
+    line about the same however many rules there are.
+    """
+    if run_benchmark:
+        benchmark()
+        return
+    if not log_files:
+        raise click.UsageError('Missing argument LOG_FILES')
+    if secret is None:
+        raise click.UsageError('Missing option --secret')
+    try:
+        rules = [rule for path in rule_files for rule in load_rules(path)]
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    if not key_words and not rules:
+        key_words = ['suspend']
+    rules += [Rule(key_word, key_word) for key_word in key_words]
+    monitor_log(log_files, secret, rules, interval, poll, window, checkpoint,
+                formats, metrics_port, metrics_address, quiet)
 
 if __name__ == "__main__":
-    log_file = sys.argv[1]
-    bot_secret = sys.argv[2]
-    key_words = sys.argv[3]
-    monitor_log(log_file)
+    monitor_log_cli()
@@ -19,43 +19,512 @@
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import re
 import os
 import sys
 import click
+import time
+import collections
+import concurrent.futures
+
+try:
+    import numpy as np
+    from numpy.lib.stride_tricks import sliding_window_view
+except ImportError:
+    np = None
+
 #    address           perms offset  dev   inode       pathname
 #    00400000-00452000 r-xp 00000000 08:02 173521      /usr/bin/dbus-daemon
-MAPS_PATTERN = re.compile(
-    r"^(?P<BEGIN>[0-9a-fA-F]+)-(?P<END>[0-9a-fA-F]+)[\s]+(?P<PERM>[\S]+)[\s]+"\
-    r"(?P<OFFS>[\S]+)[\s]+(?P<DEV>[\S]+)[\s]+(?P<INODE>[\S]+)[\s]*(?P<PATHNAME>[^\n]*)$")
+#
+# smaps follows every mapping with "Field:   value kB" lines, of which the
+# Rss and Pss fields are summarized as well.
+SMAPS_FIELDS = {b'Rss:': 0, b'Pss:': 1}
+
+def split_key(key):
+    """Turns the "dev inode path" tail of a mapping line into a key tuple."""
+    fields = key.split(None, 2)
+    fields += [b''] * (3 - len(fields))
+    return tuple(field.rstrip(b'\n').decode('utf-8', 'backslashreplace')
+                 for field in fields)
+
+
+def parse_lines(data):
+    """Splits maps or smaps data into columns, one line at a time.
+
+    This is the fallback for systems without NumPy.
+
+    Returns:
+        Lists of the size, Rss and Pss of every mapping in bytes, its
+        (dev, inode, path) key, and whether any smaps fields were seen.
+    """
+    sizes = []
+    keys = []
+    smaps = [[], []]
+    seen_smaps = False
+    for line in data.splitlines():
+        fields = line.split(None, 5)
+        if len(fields) < 2:
+            continue
+        name = fields[0]
+        if name.endswith(b':'):
+            field = SMAPS_FIELDS.get(name)
+            if field is not None and keys:
+                smaps[field][-1] = int(fields[1]) * 1024
+                seen_smaps = True
+            continue
+        begin, sep, end = name.partition(b'-')
+        if not sep or len(fields) < 5:
+            continue
+        sizes.append(int(end, 16) - int(begin, 16))
+        keys.append(split_key(b' '.join(fields[3:])))
+        smaps[0].append(0)
+        smaps[1].append(0)
+    return sizes, keys, smaps[0], smaps[1], seen_smaps
+
+
+# Every mapping line has the spaces after its addresses, permissions and
+# offset within its first HEAD bytes, and so do the smaps fields with theirs.
+HEAD = 64
+
+
+def column_groups(head, first, last):
+    """Yields the rows of head sharing the same columns first:last.
+
+    Yields:
+        (rows, block) pairs, block being head[rows, first:last] as one
+        contiguous array. The numbers in a maps file mostly have the same
+        width, so there are only a few of them.
+    """
+    key = first * HEAD + last
+    for k in np.flatnonzero(np.bincount(key)):
+        begin, end = divmod(int(k), HEAD)
+        rows = np.flatnonzero(key == k)
+        yield rows, np.ascontiguousarray(head[rows, begin:end])
+
+
+def decode_hex(head, first, last):
+    """Decodes the hex numbers at head[i, first[i]:last[i]] into uint64 values.
+
+    The digits of every group of rows are one fixed-width string that
+    bytes.fromhex() turns into big-endian integers.
+    """
+    values = np.zeros(len(head), dtype=np.uint64)
+    for rows, block in column_groups(head, first, last):
+        if block.shape[1] % 2:
+            block = np.concatenate(
+                (np.full((len(rows), 1), ord('0'), dtype=np.uint8), block),
+                axis=1)
+        raw = np.frombuffer(bytes.fromhex(block.tobytes().decode('ascii')),
+                            dtype=np.uint8).reshape(len(rows), -1)
+        padded = np.zeros((len(rows), 8), dtype=np.uint8)
+        padded[:, 8 - raw.shape[1]:] = raw
+        values[rows] = padded.view('>u8').ravel()
+    return values
+
+
+def decode_dec(head, first, last):
+    """Decodes the decimal numbers at head[i, first[i]:last[i]]."""
+    values = np.zeros(len(head), dtype=np.int64)
+    for rows, block in column_groups(head, first, last):
+        values[rows] = block.view('S{:d}'.format(block.shape[1])).ravel() \
+                            .astype(np.int64)
+    return values
+
+
+def group_rows(rows):
+    """Numbers the distinct rows of a 2-D uint64 array.
+
+    The rows are hashed into one uint64 each, which np.unique() numbers, and
+    compared with the first row of their group, to fall back on sorting the
+    rows themselves in case of a collision.
+
+    Returns:
+        The index of the first row of every group, in order of appearance,
+        and the group of every row.
+    """
+    hashes = (rows * np.arange(1, 2 * rows.shape[1], 2, dtype=np.uint64)) \
+        .sum(axis=1, dtype=np.uint64)
+    hashes ^= hashes >> np.uint64(29)
+    hashes *= np.uint64(0xbf58476d1ce4e5b9)
+    _, first, ids = np.unique(hashes, return_index=True, return_inverse=True)
+    ids = ids.ravel()
+    if not (rows == rows[first[ids]]).all():
+        _, first, ids = np.unique(
+            rows.view('V{:d}'.format(rows.shape[1] * 8)).ravel(),
+            return_index=True, return_inverse=True)
+        ids = ids.ravel()
+
+    # np.unique() sorts the groups, renumber them by first appearance.
+    order = np.argsort(first)
+    rank = np.empty(len(first), dtype=np.int64)
+    rank[order] = np.arange(len(first))
+    return first[order], rank[ids]
+
+
+def scan_lines(data):
+    """Splits maps or smaps data into columns without looping over lines.
+
+    The first HEAD bytes of every line are laid out as the rows of a 2-D
+    array, in which the dash and spaces of the mapping lines are located and
+    the addresses decoded in bulk. The "dev inode path" tails of the mappings
+    are grouped as fixed-width rows of bytes, so only one Python object is
+    made per group rather than per mapping.
+
+    Returns:
+        The size of every mapping in bytes, the group of every mapping, the
+        raw "dev inode path" tail of every group, the Rss and Pss of every
+        mapping in bytes, and whether any smaps fields were seen.
+    """
+    if not data.endswith(b'\n'):
+        data += b'\n'
+    ends = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord('\n'))
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    lengths = ends - starts
+    buf = np.frombuffer(data + bytes(HEAD), dtype=np.uint8)
+    head = sliding_window_view(buf, HEAD)[starts]
+
+    # A mapping line starts with "begin-end perms offset ", smaps field lines
+    # with "Name:" and contain no dash before their first space.
+    lines = np.arange(len(starts))
+    spaces = head == ord(' ')
+    space = spaces.argmax(axis=1)
+    dash = (head[:, :17] == ord('-')).argmax(axis=1)
+    spaces[lines, space] = False
+    second_space = spaces.argmax(axis=1)
+    spaces[lines, second_space] = False
+    third_space = spaces.argmax(axis=1)
+    mapping = ((head[lines, dash] == ord('-')) & (dash < space) &
+               (space - dash <= 17) & (space < second_space) & (second_space < third_space) &
+               (third_space < lengths) &
+               (head[lines, np.maximum(space - 1, 0)] != ord(':')))
+    index = np.flatnonzero(mapping)
+
+    heads = head[index]
+    dash, space = dash[index], space[index]
+    sizes = (decode_hex(heads, dash + 1, space) -
+             decode_hex(heads, np.zeros_like(dash), dash))
+
+    tail_starts = starts[index] + third_space[index] + 1
+    tail_lengths = lengths[index] - third_space[index] - 1
+    keys = []
+    ids = np.zeros(len(index), dtype=np.int64)
+    if len(index):
+        width = -(-int(tail_lengths.max()) // 8) * 8 or 8
+        if width > HEAD:
+            buf = np.frombuffer(data + bytes(width), dtype=np.uint8)
+        tails = sliding_window_view(buf, width)[tail_starts]
+        tails *= np.arange(width) < tail_lengths[:, None]
+        first, ids = group_rows(tails.view(np.uint64))
+        keys = list(map(data.__getitem__,
+                        map(slice, tail_starts[first].tolist(),
+                            (tail_starts + tail_lengths)[first].tolist())))
+
+    # The Rss and Pss lines belong to the last mapping line before them.
+    columns = []
+    seen_smaps = False
+    owner = np.cumsum(mapping) - 1
+    prefixes = np.ascontiguousarray(head[:, :4]).view('<u4').ravel()
+    for name in (b'Rss:', b'Pss:'):
+        column = np.zeros(len(index), dtype=np.int64)
+        rows = np.flatnonzero(
+            prefixes == np.frombuffer(name, dtype='<u4')[0])
+        rows = rows[owner[rows] >= 0]
+        if len(rows):
+            seen_smaps = True
+            fields = head[rows]
+            first = 4 + (fields[:, 4:] != ord(' ')).argmax(axis=1)
+            after = np.arange(HEAD) > first[:, None]
+            last = (((fields == ord(' ')) | (fields == ord('\n'))) &
+                    after).argmax(axis=1)
+            column[owner[rows]] = decode_dec(fields, first, last) * 1024
+        columns.append(column)
+    return sizes, ids, keys, columns[0], columns[1], seen_smaps
+
+
+def summarize(data):
+    """Sums the size, Rss and Pss of the mappings of every (dev, inode, path).
+
+    Args:
+        data: The contents of a maps or smaps file.
+
+    Returns:
+        A dict of (dev, inode, path) -> [size, rss, pss] in bytes, in order of
+        first appearance, and whether the input was an smaps file.
+    """
+    if np is None:
+        sizes, keys, rss, pss, smaps = parse_lines(data)
+        # dict.fromkeys() and map() number the keys in order of first
+        # appearance without running Python code for every mapping.
+        groups = dict.fromkeys(keys)
+        for group, key in enumerate(groups):
+            groups[key] = group
+        ids = list(map(groups.__getitem__, keys))
+        totals = [[0, 0, 0] for _ in groups]
+        for i, group in enumerate(ids):
+            total = totals[group]
+            total[0] += sizes[i]
+            total[1] += rss[i]
+            total[2] += pss[i]
+    else:
+        sizes, ids, groups, rss, pss, smaps = scan_lines(data)
+        # bincount() sums in float64, which is exact below 2**53 bytes.
+        columns = [np.bincount(ids, weights=column, minlength=len(groups))
+                   for column in (sizes, rss, pss)]
+        totals = np.stack(columns, axis=1).astype(np.int64).tolist()
 
-def parse_file(infile, outfile):
     summary = {}
-    for line in infile:
-        obj = re.search(MAPS_PATTERN, line)
-        if obj is not None:
-            key = (obj.group('DEV'), obj.group('INODE'), obj.group('PATHNAME'))
-            iterm_size = int(obj.group('END'), 16) - int(obj.group('BEGIN'), 16)
-            if key in summary:
-                size = summary[key]
-                size += iterm_size
-            else:
-                size = iterm_size
-                summary[key] = size;
+    for key, total in zip(groups, totals):
+        if not isinstance(key, tuple):
+            key = split_key(key)
+        if key in summary:
+            summary[key] = [a + b for a, b in zip(summary[key], total)]
+        else:
+            summary[key] = total
+    return summary, smaps
+
+
+def parse_file(infile, outfile):
+    summary, smaps = summarize(infile.read())
+
+    if smaps:
+        outfile.write("{:16s}{:16s}{:16s}{:16s}{:16s}{:16s}\n".format(
+            'size', 'rss', 'pss', 'dev', 'inode', 'path'))
+        for k, v in summary.items():
+            outfile.write("{:<16d}{:<16d}{:<16d}{:16s}{:16s}{:16s}\n".format(
+                v[0], v[1], v[2], k[0], k[1], k[2]))
+        return
 
     outfile.write("{:16s}{:16s}{:16s}{:16s}\n".format('size', 'dev', 'inode', 'path'))
     for k, v in summary.items():
-        outfile.write("{:<16d}{:16s}{:16s}{:16s}\n".format(v, k[0], k[1], k[2]))
+        outfile.write("{:<16d}{:16s}{:16s}{:16s}\n".format(v[0], k[0], k[1], k[2]))
+
+def survey_pids(proc, name, pids):
+    """Sums up the mappings of some processes by path.
+
+    Processes which exit meanwhile or can not be read are skipped.
+
+    Returns:
+        A dict of path -> [processes, size, rss, pss], whether any smaps
+        fields were seen, and the number of processes skipped.
+    """
+    totals = {}
+    smaps = False
+    skipped = 0
+    for pid in pids:
+        try:
+            with open(os.path.join(proc, pid, name), 'rb') as f:
+                data = f.read()
+        except OSError:
+            skipped += 1
+            continue
+        summary, seen_smaps = summarize(data)
+        smaps |= seen_smaps
+        # Anonymous mappings share a path, but not a (dev, inode).
+        paths = {}
+        for (dev, inode, path), total in summary.items():
+            path = path or '[anon]'
+            if path in paths:
+                paths[path] = [a + b for a, b in zip(paths[path], total)]
+            else:
+                paths[path] = total
+        for path, total in paths.items():
+            entry = totals.setdefault(path, [0, 0, 0, 0])
+            entry[0] += 1
+            entry[1] += total[0]
+            entry[2] += total[1]
+            entry[3] += total[2]
+    return totals, smaps, skipped
+
+
+def survey(proc='/proc', name='maps', jobs=None):
+    """Sums up the mappings of every process by path, in a process pool.
+
+    Args:
+        proc: Where procfs is mounted.
+        name: 'maps', or 'smaps' to sum up Rss and Pss as well.
+        jobs: Number of worker processes (Default: CPU count).
+
+    Returns:
+        The same as survey_pids(), for all processes, and the number of
+        processes found.
+    """
+    pids = [pid for pid in os.listdir(proc) if pid.isdigit()]
+    jobs = max(1, min(jobs or os.cpu_count() or 1, len(pids)))
+
+    # Each worker sums up a slice of the processes, so that only one dict
+    # per worker has to be sent back.
+    parts = [pids[i::jobs] for i in range(jobs)]
+    totals = {}
+    smaps = False
+    skipped = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(survey_pids, proc, name, part)
+                   for part in parts]
+        for future in futures:
+            part_totals, part_smaps, part_skipped = future.result()
+            smaps |= part_smaps
+            skipped += part_skipped
+            for path, total in part_totals.items():
+                if path in totals:
+                    totals[path] = [a + b for a, b in zip(totals[path], total)]
+                else:
+                    totals[path] = total
+    return totals, smaps, skipped, len(pids)
+
+
+def survey_file(outfile, name, jobs, top):
+    totals, smaps, skipped, count = survey(name=name, jobs=jobs)
+
+    # Rank by Pss when available, since it splits shared pages fairly.
+    column = 3 if smaps else 1
+    ranked = sorted(totals.items(), key=lambda item: item[1][column],
+                    reverse=True)
+    if top:
+        ranked = ranked[:top]
+
+    if smaps:
+        outfile.write("{:10s}{:16s}{:16s}{:16s}{:s}\n".format(
+            'procs', 'size', 'rss', 'pss', 'path'))
+        for path, v in ranked:
+            outfile.write("{:<10d}{:<16d}{:<16d}{:<16d}{:s}\n".format(
+                v[0], v[1], v[2], v[3], path))
+    else:
+        outfile.write("{:10s}{:16s}{:s}\n".format('procs', 'size', 'path'))
+        for path, v in ranked:
+            outfile.write("{:<10d}{:<16d}{:s}\n".format(v[0], v[1], path))
+    outfile.write("{:d} processes, {:d} skipped\n".format(count, skipped))
+
+class MapsWatcher:
+    """Samples the maps or smaps of a process and tracks how it grows.
+
+    Only the changes between consecutive samples are kept, in a ring buffer
+    of the last window samples, together with their running sum. Growth over
+    the window is therefore known without keeping any full sample but the
+    last one.
+    """
+
+    def __init__(self, path, window):
+        self.path = path
+        self.last = None
+        self.deltas = collections.deque(maxlen=window)
+        self.growth = {}
+        self.samples = 0
+
+    def _add(self, delta, sign):
+        for key, change in delta.items():
+            total = [a + sign * b for a, b in
+                     zip(self.growth.get(key, (0, 0, 0)), change)]
+            if any(total):
+                self.growth[key] = total
+            else:
+                self.growth.pop(key, None)
+
+    def sample(self):
+        """Reads the maps once and records the change since the last sample.
+
+        Returns:
+            Whether the input is an smaps file.
+        """
+        with open(self.path, 'rb') as f:
+            summary, smaps = summarize(f.read())
+        if self.last is not None:
+            delta = {}
+            for key in summary.keys() | self.last.keys():
+                new = summary.get(key, (0, 0, 0))
+                old = self.last.get(key, (0, 0, 0))
+                if new != old:
+                    delta[key] = [a - b for a, b in zip(new, old)]
+            if len(self.deltas) == self.deltas.maxlen:
+                self._add(self.deltas[0], -1)
+            self.deltas.append(delta)
+            self._add(delta, 1)
+        self.last = summary
+        self.samples += 1
+        return smaps
+
+    def grown(self, column=0):
+        """Returns (key, growth) of the mappings grown over the window,
+        largest growth first."""
+        grown = [(key, change) for key, change in self.growth.items()
+                 if change[column] > 0]
+        return sorted(grown, key=lambda item: item[1][column], reverse=True)
+
+
+def watch_file(outfile, path, interval, window, count, top):
+    watcher = MapsWatcher(path, window)
+    deadline = time.monotonic()
+    smaps = False
+    try:
+        while not count or watcher.samples < count:
+            try:
+                smaps = watcher.sample()
+            except (FileNotFoundError, ProcessLookupError):
+                outfile.write("{:s} is gone\n".format(path))
+                break
+            if watcher.samples > 1 and (watcher.samples - 1) % window == 0:
+                report_growth(outfile, watcher, smaps, top)
+            deadline += interval
+            time.sleep(max(0, deadline - time.monotonic()))
+    except KeyboardInterrupt:
+        pass
+    if (watcher.samples - 1) % window:
+        report_growth(outfile, watcher, smaps, top)
+
+
+def report_growth(outfile, watcher, smaps, top):
+    # Rss is what a leak shows up in, when available.
+    grown = watcher.grown(1 if smaps else 0)
+    if top:
+        grown = grown[:top]
+    outfile.write("{:s} grown over the last {:d} samples:\n".format(
+        time.strftime('%Y-%m-%d %H:%M:%S'), len(watcher.deltas)))
+    if smaps:
+        outfile.write("{:16s}{:16s}{:16s}{:16s}{:16s}{:16s}\n".format(
+            'size', 'rss', 'pss', 'dev', 'inode', 'path'))
+        for k, v in grown:
+            outfile.write("{:<+16d}{:<+16d}{:<+16d}{:16s}{:16s}{:16s}\n".format(
+                v[0], v[1], v[2], k[0], k[1], k[2] or '[anon]'))
+    else:
+        outfile.write("{:16s}{:16s}{:16s}{:16s}\n".format(
+            'size', 'dev', 'inode', 'path'))
+        for k, v in grown:
+            outfile.write("{:<+16d}{:16s}{:16s}{:16s}\n".format(
+                v[0], k[0], k[1], k[2] or '[anon]'))
+    outfile.flush()
 
 @click.command()
-@click.option('-p', '--parse', 'infile', type=click.File('r'),
-              help='/proc/<pid>/maps file to parse.' +
-              '(Default: stdin)', required=False, default=sys.stdin)
+@click.option('-p', '--parse', 'infile', type=click.File('rb'),
+              help='/proc/<pid>/maps or /proc/<pid>/smaps file to parse.' +
+              '(Default: stdin)', required=False, default='-')
 @click.option('-o', '--output', 'outfile', type=click.File('w'),
               help="Output file path (Default: std output)",
               required=False, default=sys.stdout)
-def summary_maps(infile, outfile):
+@click.option('-a', '--all', 'all_pids', is_flag=True,
+              help='Summarize the mappings of all processes by path.')
+@click.option('-s', '--smaps', is_flag=True,
+              help='With --all or --watch, read smaps to sum up Rss and ' +
+              'Pss as well.')
+@click.option('-j', '--jobs', type=int, default=None,
+              help='With --all, number of worker processes (Default: CPU count).')
+@click.option('-n', '--top', type=int, default=0,
+              help='With --all or --watch, only print the N largest paths.')
+@click.option('-w', '--watch', 'pid', type=int, default=None,
+              help='Sample the maps of PID and report the mappings that grew.')
+@click.option('-i', '--interval', type=float, default=10.0,
+              help='With --watch, seconds between samples (Default: 10).')
+@click.option('--window', type=click.IntRange(min=1), default=60,
+              help='With --watch, samples to report growth over (Default: 60).')
+@click.option('-c', '--count', type=int, default=0,
+              help='With --watch, stop after N samples (Default: never).')
+def summary_maps(infile, outfile, all_pids, smaps, jobs, top, pid, interval,
+                 window, count):
     """summary_maps entry"""
+    if pid is not None:
+        path = '/proc/{:d}/{:s}'.format(pid, 'smaps' if smaps else 'maps')
+        watch_file(outfile, path, interval, window, count, top)
+        return
+    if all_pids:
+        survey_file(outfile, 'smaps' if smaps else 'maps', jobs, top)
+        return
     parse_file(infile, outfile)
 
 if __name__ == '__main__':
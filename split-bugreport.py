@@ -22,38 +22,424 @@
 import re
 import os
 import sys
+import glob
+import json
+import mmap
+import gzip
+import zipfile
+import concurrent.futures
 import click
 
-SESSION_PATTERN = re.compile(r"(?:^-{1,10}[\s]*)(?P<TITLE>[^\(]+)(?:\()")
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
+# Section headers look like "------ MEMORY INFO (/proc/meminfo) ------". The
+# pattern is matched against whole blocks of lines, so it must not run past
+# the end of a line.
+SESSION_PATTERN = re.compile(
+    rb"(?:^-{1,10}[^\S\n]*)(?P<TITLE>[^\(\n]+)(?:\()", re.MULTILINE)
 
-def parse_file(infile, outfile):
-    try:
-        os.mkdir(outfile)
-    except OSError as e:
-        pass
+BLOCK_SIZE = 8 * 1024 * 1024
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+def iter_blocks(infile, block_size=BLOCK_SIZE):
+    """Reads a stream in large blocks which hold whole lines only.
+
+    Yields:
+        (offset, block) tuples, where offset is the position of the block in
+        the stream.
+    """
+    offset = 0
+    rest = b''
+    while True:
+        data = infile.read(block_size)
+        if not data:
+            break
+        data = rest + data
+        end = data.rfind(b'\n') + 1
+        if not end:
+            rest = data
+            continue
+        rest = data[end:]
+        yield offset, data[:end]
+        offset += end
+    if rest:
+        yield offset, rest
+
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZIP_MAGIC = b'PK\x03\x04'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def compression(infile):
+    """Returns 'gzip', 'zip', 'zstd' or None from the magic of a stream.
+
+    The stream must support peek(), like files opened in 'rb' mode and
+    sys.stdin.buffer do, so that nothing is consumed.
+    """
+    magic = infile.peek(4)[:4]
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if magic == ZIP_MAGIC:
+        return 'zip'
+    if magic == ZSTD_MAGIC:
+        return 'zstd'
+    return None
+
+
+def zip_main_entry(archive):
+    """Finds the bugreport text in an Android bugreport zip.
+
+    main_entry.txt names it in zips written by dumpstate, otherwise the
+    largest bugreport*.txt, or the largest .txt file, is taken.
+    """
+    names = archive.namelist()
+    if 'main_entry.txt' in names:
+        name = archive.read('main_entry.txt').decode().strip()
+        if name in names:
+            return name
+    texts = [info for info in archive.infolist()
+             if info.filename.endswith('.txt') and not info.is_dir()]
+    if not texts:
+        raise click.ClickException('no bugreport text in the zip file')
+    texts.sort(key=lambda info: (os.path.basename(info.filename)
+                                 .startswith('bugreport'), info.file_size))
+    return texts[-1].filename
+
+
+def open_bugreport(infile):
+    """Returns a binary stream of the bugreport text in infile.
+
+    zip, gzip and zstd compressed bugreports are decompressed on the fly,
+    without being extracted to disk first.
+
+    Returns:
+        The stream, and the name of the bugreport for the section index.
+    """
+    name = getattr(infile, 'name', '-')
+    kind = compression(infile)
+    if kind == 'gzip':
+        return gzip.GzipFile(fileobj=infile, mode='rb'), name
+    if kind == 'zstd':
+        if zstandard is None:
+            raise click.ClickException(
+                'zstd compressed bugreports need the zstandard module')
+        return zstandard.ZstdDecompressor().stream_reader(infile), name
+    if kind == 'zip':
+        if not infile.seekable():
+            raise click.UsageError('zip files can not be read from a pipe')
+        archive = zipfile.ZipFile(infile)
+        entry = zip_main_entry(archive)
+        return archive.open(entry), '{:s}:{:s}'.format(name, entry)
+    return infile, name
+
+
+def section_name(title, names):
+    """Turns a section title into a file name not in names yet."""
+    name = title.decode('utf-8', 'replace').strip(' -=.')
+    name = name.replace(' ', '-').replace(os.sep, '-') or 'unnamed'
+    if name in names:
+        count = 2
+        while '{:s}-{:d}'.format(name, count) in names:
+            count += 1
+        name = '{:s}-{:d}'.format(name, count)
+    return name
+
+
+def split_stream(infile, outdir=None):
+    """Splits a bugreport into its sections in one pass.
+
+    Args:
+        infile: Binary stream of the bugreport.
+        outdir: Directory to write every section to, or None to only index.
+
+    Returns:
+        An ordered dict of section name -> [offset, length, lines], where
+        offset and length are in bytes in the bugreport. Repeated section
+        titles get a "-2", "-3"... suffix.
+    """
+    sections = {}
+    section = None
     output = None
-    for line in infile:
-        obj = re.search(SESSION_PATTERN, line)
-        if obj is not None:
-            print(line)
-            if output is not None:
-                output.close()
-            output = open(os.path.join(outfile, obj.group('TITLE').strip(' -=.').replace(' ', '-')), 'w')
-            print("session: {:s}".format(obj.group('TITLE')))
+    size = 0
+
+    def close_section(end):
+        if section is not None:
+            section[1] = end - section[0]
         if output is not None:
-            output.write(line)
+            output.close()
+
+    for offset, block in iter_blocks(infile):
+        view = memoryview(block)
+        pos = 0
+        for obj in SESSION_PATTERN.finditer(block):
+            start = obj.start()
+            if section is not None:
+                section[2] += block.count(b'\n', pos, start)
+                if output is not None:
+                    output.write(view[pos:start])
+            close_section(offset + start)
+            name = section_name(obj.group('TITLE'), sections)
+            section = sections[name] = [offset + start, 0, 0]
+            if outdir is not None:
+                output = open(os.path.join(outdir, name), 'wb',
+                              buffering=WRITE_BUFFER_SIZE)
+            pos = start
+        if section is not None:
+            section[2] += block.count(b'\n', pos)
+            # A last line without a newline is still a line.
+            if not block.endswith(b'\n'):
+                section[2] += 1
+            if output is not None:
+                output.write(view[pos:])
+        size = offset + len(block)
+    close_section(size)
+    return sections
+
+
+def write_index(path, name, sections, st=None):
+    """Writes the section index of a bugreport.
+
+    Args:
+        st: os.stat_result of the bugreport, to tell when the index is
+            stale, for bugreports which are plain files.
+    """
+    index = {
+        'file': name,
+        'sections': sections,
+    }
+    if st is not None:
+        index['size'] = st.st_size
+        index['mtime'] = st.st_mtime
+    with open(path + '.tmp', 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def load_index(path, infile):
+    """Loads a section index, if it is still up to date with infile.
+
+    Returns:
+        The sections of the index, or None when the index is missing or was
+        written for another version of the bugreport.
+    """
+    try:
+        with open(path) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    st = os.fstat(infile.fileno())
+    if index.get('size') != st.st_size or index.get('mtime') != st.st_mtime:
+        return None
+    return index['sections']
+
+
+def select_sections(sections, queries):
+    """Returns the names of sections matching any of the queries.
+
+    A query is a case-insensitive regular expression searched for in the
+    section name, with spaces standing for the dashes of the name.
+    """
+    if not queries:
+        return list(sections)
+    patterns = [re.compile(query.replace(' ', '-'), re.IGNORECASE)
+                for query in queries]
+    return [name for name in sections
+            if any(pattern.search(name) for pattern in patterns)]
+
+
+def grep_range(data, pattern, start, end):
+    """Yields the lines of data[start:end] that pattern matches."""
+    pos = start
+    while True:
+        obj = pattern.search(data, pos, end)
+        if obj is None:
+            return
+        line_start = data.rfind(b'\n', start, obj.start()) + 1 or start
+        line_end = data.find(b'\n', obj.end(), end)
+        if line_end < 0:
+            line_end = end
+        yield data[line_start:line_end]
+        pos = line_end + 1
+        if pos >= end:
+            return
+
+
+def query_file(infile, index, queries, grep, outfile):
+    """Prints sections of a bugreport, or the lines of them grep matches.
+
+    Only the byte ranges of the selected sections are read, through an mmap
+    of the bugreport. The section index is built first when it is missing
+    or out of date.
+    """
+    sections = load_index(index, infile)
+    if sections is None:
+        sections = split_stream(infile)
+        try:
+            write_index(index, infile.name, sections,
+                        os.fstat(infile.fileno()))
+        except OSError as e:
+            print("{:s}: {:s}".format(index, str(e)), file=sys.stderr)
+    names = select_sections(sections, queries)
+    if not names or not os.fstat(infile.fileno()).st_size:
+        return 1
+
+    pattern = re.compile(grep.encode(), re.MULTILINE) if grep is not None else None
+    found = pattern is None
+    with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for name in names:
+            offset, length, lines = sections[name]
+            if pattern is None:
+                outfile.write(data[offset:offset + length])
+                continue
+            prefix = name.encode() + b':'
+            for line in grep_range(data, pattern, offset, offset + length):
+                outfile.write(prefix + line + b'\n')
+                found = True
+    return 0 if found else 1
+
+
+def parse_file(infile, outfile, index=None, split=True):
+    stream, name = open_bugreport(infile)
+    st = None
+    if stream is infile and os.path.isfile(name):
+        st = os.fstat(infile.fileno())
+    if split:
+        os.makedirs(outfile, exist_ok=True)
+    with stream:
+        sections = split_stream(stream, outfile if split else None)
+    if index is None and split:
+        index = os.path.join(outfile, 'index.json')
+    if index is not None:
+        write_index(index, name, sections, st)
+    print("{:d} sections".format(len(sections)))
+
+def batch_inputs(patterns):
+    """Expands directories and glob patterns into a sorted list of files."""
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths.update(os.path.join(pattern, name)
+                         for name in os.listdir(pattern))
+        else:
+            paths.update(glob.glob(pattern))
+    return sorted(path for path in paths
+                  if os.path.isfile(path) and not path.endswith('.json'))
+
+
+def batch_outputs(paths, outdir):
+    """Names an output directory for every bugreport after its file name."""
+    outputs = {}
+    names = set()
+    for path in paths:
+        name = os.path.basename(path)
+        for ext in ('.gz', '.zst', '.zip', '.txt'):
+            if name.endswith(ext):
+                name = name[:-len(ext)]
+        name = section_name(name.encode(), names)
+        names.add(name)
+        outputs[path] = os.path.join(outdir, name)
+    return outputs
+
+
+def split_report(path, outdir):
+    """Splits one bugreport of a batch, in a worker process."""
+    with open(path, 'rb') as infile:
+        stream, name = open_bugreport(infile)
+        st = os.fstat(infile.fileno()) if stream is infile else None
+        os.makedirs(outdir, exist_ok=True)
+        with stream:
+            sections = split_stream(stream, outdir)
+    write_index(os.path.join(outdir, 'index.json'), name, sections, st)
+    return list(sections)
+
+
+def parse_batch(patterns, outfile, jobs=None):
+    """Splits many bugreports concurrently, one process each at a time.
+
+    Every bugreport is split into its own directory under outfile, and
+    manifest.json there lists the sections found per bugreport.
+
+    Returns:
+        The number of bugreports which failed.
+    """
+    paths = batch_inputs(patterns)
+    outputs = batch_outputs(paths, outfile)
+    manifest = {}
+    failed = 0
+    os.makedirs(outfile, exist_ok=True)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(split_report, path, outputs[path]): path
+                   for path in paths}
+        for future in concurrent.futures.as_completed(futures):
+            path = futures[future]
+            report = {'output': outputs[path]}
+            try:
+                report['sections'] = future.result()
+                print("{:s}: {:d} sections".format(path,
+                                                   len(report['sections'])))
+            except Exception as e:
+                report['error'] = str(e)
+                failed += 1
+                print("{:s}: {:s}".format(path, str(e)), file=sys.stderr)
+            manifest[path] = report
+
+    manifest = {path: manifest[path] for path in paths}
+    path = os.path.join(outfile, 'manifest.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + '.tmp', path)
+    print("{:d} bugreports, {:d} failed".format(len(paths), failed))
+    return failed
 
 @click.command()
-@click.option('-p', '--parse', 'infile', type=click.File('r'),
-              help='Build log file to parse compilation commands from.' +
-              '(Default: stdin)', required=False, default=sys.stdin)
+@click.option('-p', '--parse', 'infile', type=click.File('rb'),
+              help='Bugreport file to split, may be zip/gzip/zstd compressed.' +
+              '(Default: stdin)', required=False, default='-')
 @click.option('-o', '--output', 'outfile', type=click.STRING,
-              help="Output file path (Default: std output)",
+              help="Output directory (Default: split-bugreport)",
               required=False, default='split-bugreport')
-def split_bugreport(infile, outfile):
+@click.option('-i', '--index', type=click.Path(dir_okay=False),
+              help="Section index file to write " +
+              "(Default: index.json in the output directory)",
+              required=False, default=None)
+@click.option('-n', '--no-split', 'split', is_flag=True, default=True,
+              flag_value=False,
+              help="Only write the section index, do not split.")
+@click.option('-q', '--query', 'queries', multiple=True,
+              help="Print the sections whose name matches QUERY, " +
+              "e.g. 'DUMPSYS meminfo'. May be given more than once.")
+@click.option('-g', '--grep', type=click.STRING, default=None,
+              help="Print the lines matching GREP in the queried sections " +
+              "(Default: all sections).")
+@click.option('-b', '--batch', 'patterns', multiple=True,
+              help="Split all bugreports in a directory or matching a glob " +
+              "pattern, each into its own directory under the output " +
+              "directory. May be given more than once.")
+@click.option('-j', '--jobs', type=int, default=None,
+              help="With --batch, number of worker processes " +
+              "(Default: CPU count).")
+def split_bugreport(infile, outfile, index, split, queries, grep, patterns,
+                    jobs):
     """compiledb entry"""
-    parse_file(infile, outfile)
+    if patterns:
+        sys.exit(1 if parse_batch(patterns, outfile, jobs) else 0)
+    if queries or grep is not None:
+        if not os.path.isfile(getattr(infile, 'name', '')):
+            raise click.UsageError('--query and --grep need a bugreport file')
+        if compression(infile) is not None:
+            raise click.UsageError('--query and --grep need an uncompressed '
+                                   'bugreport, the index refers to its bytes')
+        if index is None:
+            index = infile.name + '.index.json'
+        sys.exit(query_file(infile, index, queries, grep, sys.stdout.buffer))
+    if not split and index is None:
+        raise click.UsageError('--no-split needs --index')
+    parse_file(infile, outfile, index, split)
 
 if __name__ == '__main__':
     split_bugreport()